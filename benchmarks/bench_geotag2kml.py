@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of geotag2kml
+
+Subcommands:
+ - generate DIR   create a synthetic tree of geotagged files (N files over D days and M devices, a fraction of .heic/.mov files,
+                  optionally large images) and the ExifTool output expected for it (DIR/.exiftool_stub.tsv)
+ - record DIR     replace DIR/.exiftool_stub.tsv with the output of the real ExifTool (e.g. to benchmark a real case offline)
+ - run            generate a tree (or use --tree DIR) and time:
+                   * pipeline: geotag2kml.py run on the tree, the stages are read from --stats-json
+                     (ExifTool scan, timestamps and sorting, HEIC conversion, thumbnails, .KML files, distance math)
+                   * kml     : the .KML stage alone, in-process, on a synthetic exif CSV (parse and group, distance, kml_creation)
+                  The results can be saved (--save) and compared with a previous run (--baseline): the stages slower than the
+                  baseline by more than --tolerance are reported and the exit code is 1
+
+By default ExifTool (and heif-convert/magick, if pillow-heif isn't installed) are replaced by the stubs in the "stub" folder,
+which replay the recorded output: the benchmarks run offline and measure geotag2kml, not ExifTool. Use --real-exiftool to
+time the real tools. The stubs are Python scripts: Linux and macOS only.
+
+Examples:
+ python3 benchmarks/bench_geotag2kml.py run --files 2000 --days 30 --devices 3 --save base.json
+ python3 benchmarks/bench_geotag2kml.py run --files 2000 --days 30 --devices 3 --baseline base.json
+"""
+
+from datetime import datetime, timedelta
+from PIL import Image
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir    = os.path.dirname(os.path.abspath(__file__))
+script_path  = os.path.join(os.path.dirname(bench_dir), "geotag2kml.py")
+stub_dir     = os.path.join(bench_dir, "stub")
+stub_file    = ".exiftool_stub.tsv"
+#same tags (and order) as the ExifTool invocation of geotag2kml
+exift_tags   = "-datetimeoriginal -CreateDate -CreationDate -ModifyDate -filename -directory -gpslatitude# -gpslongitude# -gpsaltitude -make -model -orientation -imagewidth -imageheight"
+small_size   = (320, 240)
+large_size   = (4032, 3024)
+
+
+#***************** FUNCTIONS *****************
+def gps_dms(value):
+	#Decimal degrees -> (degrees, minutes, seconds) for the GPS IFD
+	value   = abs(value)
+	degrees = int(value)
+	minutes = int((value - degrees) * 60)
+	return (degrees, minutes, round((value - degrees - minutes / 60) * 3600, 4))
+
+def image_exif(ts, lat, long, make, model, orientation):
+	#EXIF data of a synthetic photo: Make, Model, Orientation, DateTimeOriginal and GPS
+	exif = Image.Exif()
+	exif[0x010F] = make
+	exif[0x0110] = model
+	exif[0x0112] = orientation
+	exif.get_ifd(0x8769)[0x9003] = ts #DateTimeOriginal
+	gps = exif.get_ifd(0x8825)
+	gps[1] = "N" if lat >= 0 else "S"
+	gps[2] = gps_dms(lat)
+	gps[3] = "E" if long >= 0 else "W"
+	gps[4] = gps_dms(long)
+	gps[5] = b"\x00" #Above Sea Level
+	gps[6] = 120.0
+	return exif
+
+def waypoints_synthetic(files, days, devices, heic, mov, seed):
+	#Waypoints of a synthetic case: every device walks around its own starting point, the files are spread over the days
+	rng   = random.Random(seed)
+	start = datetime(2020, 1, 1, 8, 0, 0)
+	waypoints = []
+	positions = [(45 + rng.random(), 9 + rng.random()) for device in range(devices)]
+	for i in range(files):
+		device    = i % devices
+		day       = i * days // files
+		ts        = start + timedelta(days=day, seconds=(i % max(1, files // days)) * 30)
+		lat, long = positions[device]
+		lat, long = lat + rng.uniform(-0.001, 0.001), long + rng.uniform(-0.001, 0.001)
+		positions[device] = (lat, long)
+		kind      = rng.random()
+		ext       = ".heic" if kind < heic else ".mov" if kind < heic + mov else ".jpg"
+		rotated   = ext == ".jpg" and rng.random() < 0.2
+		waypoints.append({"fn": "IMG_%06d%s" % (i, ext), "dir": "dev%d/DCIM/%03d" % (device, day), "ts": ts.strftime("%Y:%m:%d %H:%M:%S"),
+			"lat": lat, "long": long, "make": "Maker%d" % device, "model": "Model %d" % device, "orientation": 6 if rotated else 1})
+	return waypoints
+
+def stub_row(wp, size):
+	#Row printed by "exiftool -T" for a waypoint, columns as geotag2kml's temp_columns
+	orientation = "Rotate 90 CW" if wp["orientation"] == 6 else "Horizontal (normal)"
+	if wp["fn"].endswith(".mov"):
+		dates = ["-", "-", wp["ts"] + "+01:00", "-"] #DateTimeOriginal, CreateDate, CreationDate, ModifyDate
+		orientation, size = "-", (1920, 1080)
+	else:
+		dates = [wp["ts"], wp["ts"], "-", wp["ts"]]
+	return "\t".join(dates + [wp["fn"], wp["dir"], "%.6f" % wp["lat"], "%.6f" % wp["long"], "120 m Above Sea Level",
+		wp["make"], wp["model"], orientation, str(size[0]), str(size[1])]) + "\n"
+
+def tree_generate(root, files, days, devices, heic, mov, large, seed):
+	#Create the synthetic files and the recorded ExifTool output (root/.exiftool_stub.tsv)
+	size = large_size if large else small_size
+	if heic > 0 and importlib.util.find_spec("pillow_heif") is None:
+		print (" WARNING: pillow-heif is not installed, the .heic files are created as .jpg")
+		heic = 0
+	if heic > 0:
+		import pillow_heif
+		pillow_heif.register_heif_opener()
+	waypoints = waypoints_synthetic(files, days, devices, heic, mov, seed)
+	rng = random.Random(seed)
+	with open(os.path.join(root, stub_file), 'w', encoding="utf-8") as w:
+		for wp in waypoints:
+			os.makedirs(os.path.join(root, wp["dir"]), exist_ok=True)
+			path = os.path.join(root, wp["dir"], wp["fn"])
+			if wp["fn"].endswith(".mov"):
+				with open(path, 'wb') as mov_file:
+					mov_file.write(os.urandom(4096)) #not a real video: only the recorded metadata are used
+			else:
+				im = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+				im.save(path, "HEIF" if wp["fn"].endswith(".heic") else "JPEG", exif=image_exif(wp["ts"], wp["lat"], wp["long"], wp["make"], wp["model"], wp["orientation"]), quality=85)
+			w.write(stub_row(wp, size))
+	return waypoints
+
+def tree_record(root):
+	#Record the output of the real ExifTool for the stub
+	exift_out = subprocess.run(["exiftool", "-r", "-q", "-charset", "filename=utf8", "-if", "defined $gpslongitude", "-T"] + exift_tags.split() + ["."],
+		cwd=root, stdout=subprocess.PIPE, encoding="utf-8", errors="replace").stdout
+	rows = []
+	for row in exift_out.splitlines():
+		column = row.split("\t")
+		if len(column) == len(exift_tags.split()):
+			if column[5].startswith("./"):
+				column[5] = column[5][2:] #geotag2kml sends paths relative to the given path: dev0/DCIM, not ./dev0/DCIM
+			rows.append("\t".join(column) + "\n")
+	with open(os.path.join(root, stub_file), 'w', encoding="utf-8") as w:
+		w.writelines(rows)
+	return len(rows)
+
+def stages_add(results, suite, stage, seconds, items):
+	results["%s: %s" % (suite, stage)] = {"seconds": seconds, "items": items}
+
+def pipeline_run(root, args, results):
+	#Run geotag2kml on the tree (--no-index --no-cache: every run does all the work) and collect the stages of --stats-json
+	env = dict(os.environ)
+	if not args.real_exiftool:
+		env["PATH"] = stub_dir + os.pathsep + env.get("PATH", "")
+	best = {}
+	for repeat in range(args.repeat):
+		stats_json = os.path.join(tempfile.mkdtemp(prefix="geotag2kml_bench_"), "stats.json")
+		before = set(os.listdir(root))
+		started = time.perf_counter()
+		run = subprocess.run([sys.executable, script_path, root, "--no-index", "--no-cache", "--jobs", str(args.jobs), "--stats-json", stats_json] + args.extra,
+			env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8", errors="replace")
+		duration = time.perf_counter() - started
+		for name in set(os.listdir(root)) - before: #outputs of the run
+			output = os.path.join(root, name)
+			shutil.rmtree(output) if os.path.isdir(output) else os.remove(output)
+		if run.returncode != 0 or not os.path.exists(stats_json):
+			print (run.stdout)
+			sys.exit("\n ERROR: geotag2kml failed (exit code %d)" % run.returncode)
+		with open(stats_json) as r:
+			stats = json.load(r)
+		shutil.rmtree(os.path.dirname(stats_json))
+		stages = [("total", duration, stats["waypoints"])] + [(stage["stage"].strip(), stage["wall_s"], stage["items"]) for stage in stats["stages"]]
+		for stage, seconds, items in stages:
+			if stage not in best or seconds < best[stage][0]:
+				best[stage] = (seconds, items)
+	for stage, (seconds, items) in best.items():
+		stages_add(results, "pipeline", stage, seconds, items)
+
+def kml_run(waypoints, args, results):
+	#Time the .KML stage in-process on a synthetic exif CSV (no thumbnails: they are timed by the pipeline)
+	spec = importlib.util.spec_from_file_location("geotag2kml", script_path)
+	g    = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(g)
+	work = tempfile.mkdtemp(prefix="geotag2kml_bench_")
+	waypoints = sorted(waypoints, key=lambda wp: wp["ts"])
+	g.file_exif = os.path.join(work, "exif.csv")
+	with open(g.file_exif, 'w') as w:
+		w.write("Timestamp\tFilename\tDirectory\tGpsLatitude#\tGpsLongitude#\tGpsAltitude\tMake\tModel\tOrientation\tImageWidth\tImageHeight\n")
+		for wp in waypoints:
+			w.write(wp["ts"] + "\t" + stub_row(wp, small_size).split("\t", 4)[4])
+	g.args             = argparse.Namespace(distance="haversine", simplify=None, cluster=None, cluster_time=10, regionate=False, region_size=500)
+	g.numlines         = len(waypoints)
+	g.uniq_dates       = sorted(set(wp["ts"][:10] for wp in waypoints))
+	g.uniq_models      = sorted(set(wp["make"] + " " + wp["model"] for wp in waypoints))
+	g.file_GoogleEarth = os.path.join(work, "bench_")
+	g.prefix_thumbs    = "bench_thumbs"
+	g.prefix_heic      = "bench_heic"
+	g.thumbs_failed    = set()
+	g.clustered_rows   = set()
+	g.kmz_files        = {}
+	days = None
+	for repeat in range(args.repeat):
+		stage_times = []
+		started = time.perf_counter()
+		days = [(date, date_rows) for date, date_rows in g.exif_days()]
+		stage_times.append(("parse and group", time.perf_counter() - started))
+		for distance in ["haversine", "geodesic"]:
+			g.args.distance = distance
+			started = time.perf_counter()
+			for date, date_rows in days:
+				g.path_distance(date_rows)
+			stage_times.append(("distance %s" % distance, time.perf_counter() - started))
+		g.args.distance = "haversine" #kml_creation measures the serialization, not the distance
+		started = time.perf_counter()
+		g.kml_creation(["icons", "thumbs"])
+		stage_times.append(("kml_creation", time.perf_counter() - started))
+		for stage, seconds in stage_times:
+			key = "kml: %s" % stage
+			if key not in results or seconds < results[key]["seconds"]:
+				stages_add(results, "kml", stage, seconds, len(waypoints))
+	shutil.rmtree(work)
+
+def results_compare(results, baseline, tolerance):
+	#Stages slower than the baseline by more than tolerance (stages shorter than 50 ms are too noisy and are skipped)
+	regressions = []
+	print ("\n%-40s %12s %12s %8s" % ("Stage", "Baseline (s)", "Now (s)", "Change"))
+	for stage, result in results.items():
+		if stage not in baseline:
+			continue
+		base_seconds = baseline[stage]["seconds"]
+		change = (result["seconds"] - base_seconds) / base_seconds if base_seconds > 0 else 0
+		flag = ""
+		if base_seconds >= 0.05 and change > tolerance:
+			regressions.append(stage)
+			flag = "  <== REGRESSION"
+		print ("%-40s %12.3f %12.3f %+7.0f%%%s" % (stage, base_seconds, result["seconds"], change * 100, flag))
+	return regressions
+
+def arguments():
+	parser = argparse.ArgumentParser(description="Benchmarks of geotag2kml on synthetic geotagged files")
+	commands = parser.add_subparsers(dest="command", required=True)
+	for command in ["generate", "run"]:
+		command_parser = commands.add_parser(command)
+		if command == "generate":
+			command_parser.add_argument("tree", help="folder where the synthetic files are created")
+		command_parser.add_argument("--files", type=int, default=1000, metavar="N", help="number of files (default: 1000)")
+		command_parser.add_argument("--days", type=int, default=10, metavar="D", help="number of days (default: 10)")
+		command_parser.add_argument("--devices", type=int, default=2, metavar="M", help="number of devices (default: 2)")
+		command_parser.add_argument("--heic", type=float, default=0.0, metavar="FRACTION", help="fraction of .heic files (default: 0, requires pillow-heif)")
+		command_parser.add_argument("--mov", type=float, default=0.0, metavar="FRACTION", help="fraction of .mov files (default: 0)")
+		command_parser.add_argument("--large", action="store_true", help="create %dx%d images instead of %dx%d" % (large_size + small_size))
+		command_parser.add_argument("--seed", type=int, default=1, help="seed of the random generator (default: 1)")
+	record_parser = commands.add_parser("record")
+	record_parser.add_argument("tree", help="folder whose ExifTool output is recorded for the stub")
+	run_parser = commands.choices["run"]
+	run_parser.add_argument("--tree", metavar="DIR", help="use an existing tree (with its recorded output) instead of generating one")
+	run_parser.add_argument("--kml-rows", type=int, metavar="N", help="rows of the exif CSV of the kml suite (default: --files)")
+	run_parser.add_argument("--suite", choices=["all", "pipeline", "kml"], default="all")
+	run_parser.add_argument("--repeat", type=int, default=3, help="repetitions, the best time of each stage is kept (default: 3)")
+	run_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="--jobs of geotag2kml (default: number of CPUs)")
+	run_parser.add_argument("--real-exiftool", action="store_true", help="use the real ExifTool instead of the stub")
+	run_parser.add_argument("--save", metavar="FILE", help="save the results in a JSON file")
+	run_parser.add_argument("--baseline", metavar="FILE", help="compare the results with a JSON file saved by --save")
+	run_parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown reported as a regression (default: 0.25 = 25%%)")
+	run_parser.add_argument("extra", nargs=argparse.REMAINDER, help="other options passed to geotag2kml after --, e.g. -- --kmz")
+	return parser.parse_args()
+
+
+#***************** BEGIN *****************
+if __name__ == "__main__":
+	args = arguments()
+
+	if args.command == "generate":
+		os.makedirs(args.tree, exist_ok=True)
+		tree_generate(args.tree, args.files, args.days, args.devices, args.heic, args.mov, args.large, args.seed)
+		print ("%d file(s) created in %s" % (args.files, args.tree))
+		sys.exit()
+
+	if args.command == "record":
+		print ("%d row(s) recorded in %s" % (tree_record(args.tree), os.path.join(args.tree, stub_file)))
+		sys.exit()
+
+	args.extra = [extra for extra in args.extra if extra != "--"]
+	results = {}
+	tree = None
+	if args.suite in ["all", "pipeline"]:
+		if args.tree:
+			root = os.path.abspath(args.tree)
+		else:
+			tree = tempfile.mkdtemp(prefix="geotag2kml_tree_")
+			root = tree
+			tree_generate(root, args.files, args.days, args.devices, args.heic, args.mov, args.large, args.seed)
+		pipeline_run(root, args, results)
+	if args.suite in ["all", "kml"]:
+		kml_rows = args.kml_rows or args.files
+		kml_run(waypoints_synthetic(kml_rows, args.days, args.devices, args.heic, args.mov, args.seed), args, results)
+	if tree is not None:
+		shutil.rmtree(tree)
+
+	print ("\n%-40s %12s %12s %12s" % ("Stage", "Seconds", "Items", "Items/s"))
+	for stage, result in results.items():
+		print ("%-40s %12.3f %12d %12s" % (stage, result["seconds"], result["items"], "%.1f" % (result["items"] / result["seconds"]) if result["seconds"] > 0 else "-"))
+
+	if args.save:
+		with open(args.save, 'w') as w:
+			json.dump({"created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(), "platform": platform.platform(),
+				"params": {"files": args.files, "days": args.days, "devices": args.devices, "heic": args.heic, "mov": args.mov, "large": args.large,
+					"seed": args.seed, "jobs": args.jobs, "real_exiftool": args.real_exiftool, "extra": args.extra},
+				"results": results}, w, indent=1)
+		print ("\nResults saved in %s" % args.save)
+
+	if args.baseline:
+		with open(args.baseline) as r:
+			baseline = json.load(r)["results"]
+		regressions = results_compare(results, baseline, args.tolerance)
+		if regressions:
+			print ("\n%d stage(s) slower than the baseline by more than %d%%" % (len(regressions), args.tolerance * 100))
+			sys.exit(1)
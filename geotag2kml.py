@@ -22,12 +22,16 @@ Author    : Gabriele Zambelli (Twitter: @gazambelli)
 Blog post : https://forensenellanebbia.blogspot.com/2015/08/geotag2kml-python-script-to-create-kml.html
 
 This script will create a Google Earth KML file from geotagged photos and videos
+It can also be imported: geotag2kml.run(path, **options), see PIPELINE
 
 Prerequisites (see the Readme file for more information):
  - Python v3.8+
     * geopy       : https://pypi.org/project/geopy/
     * Pillow      : https://python-pillow.org/
     * randomcolor : https://pypi.org/project/randomcolor/
+    * NumPy       : https://numpy.org/ (optional)
+    * pillow-heif : https://pypi.org/project/pillow-heif/ (optional, replaces ImageMagick/libheif)
+    * PyArrow     : https://arrow.apache.org/docs/python/ (optional, --export parquet/arrow)
  - ExifTool       : https://exiftool.org/
    (If you're using Windows, please rename the executable of ExifTool to "exiftool.exe")
  - ImageMagick    : https://imagemagick.org/
@@ -64,67 +68,1178 @@ References:
   - Examples                          : https://github.com/davidmerfield/randomColor
 """
 
-from collections import Counter
-from datetime import datetime
-from geopy.distance import geodesic
-from PIL import Image, ExifTags
-import csv
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import functools
+import hashlib
+import heapq
+import importlib.util
+import io
+import itertools
+import json
+import math
 import os
 import platform
-import randomcolor
+import posixpath
+import queue
+import re
+import select
+import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
+import time
+import zipfile
 
 version            = "0.7"
-line_colors_random = []
+earth_radius       = 6371008.8 #mean Earth radius in meters, used by the haversine formula
+thumbs_size        = (100, 150)
+thumbs_params      = "thumbs|%dx%d|q80" % thumbs_size #output parameters of the thumbnails, part of the cache key
+#waypoint: a row of the CSV sorted by Timestamp (see waypoint_parse)
+Waypoint           = namedtuple("Waypoint", ["row", "ts", "dt", "fn", "dir", "lat", "long", "alt", "alt_text", "make", "model", "orient", "imgw", "imgh"])
+temp_columns       = ["DateTimeOriginal", "CreateDate", "CreationDate", "ModifyDate", "Filename", "Directory", "GpsLatitude", "GpsLongitude", "GpsAltitude", "Make", "Model", "Orientation", "ImageWidth", "ImageHeight"] #tags extracted by ExifTool
+timestamp_fields   = {True: ["CreationDate", "CreateDate", "ModifyDate"], False: ["DateTimeOriginal", "CreateDate", "CreationDate", "ModifyDate"]} #order of choice of the Timestamp of .mov files (True) and of the other files (False)
+timestamp_pattern  = re.compile(r"(\d{4})[:-](\d\d)[:-](\d\d)[ T](\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?") #EXIF/QuickTime timestamp, optional subseconds and UTC offset
+timestamps_slice   = 65536 #timestamps parsed together by NumPy, bounds the memory of the matrices of timestamps_array
+output_pattern     = re.compile(r"\d{8}_\d{6}_(?:[\w.-]+_)?(?:temp\.csv|exif\.csv|heic_args\.txt|(?:icons|thumbs)(?:\.kml|\.kmz|_tiles)|thumbs|heic|days|kml\.prof|(?:waypoints|paths)\.(?:parquet|arrow)|waypoints\.geojsonl)") #output files and folders of a run: <YYYYMMDD_HHMMSS>_[<partition>_|query_]<output>
+index_file         = "geotag2kml_index.sqlite" #incremental metadata index, saved under the given path
+store_dir          = "geotag2kml_store" #binary store of the waypoints (--store) read by the query subcommand, saved under the given path
+store_record       = [("ts", "<i8"), ("lat", "<f8"), ("long", "<f8"), ("offset", "<i8"), ("length", "<i4")] #fixed-width record of a waypoint in the store
+store_nat          = -2**63 #ts of the waypoints without a valid Timestamp in the store
+store_cell         = 0.01   #size (degrees) of the cells of the grid index of the store, about 1 km
+exif_header        = "Timestamp\tFilename\tDirectory\tGpsLatitude#\tGpsLongitude#\tGpsAltitude\tMake\tModel\tOrientation\tImageWidth\tImageHeight\n" #header row of the CSV sorted by Timestamp
+exift_batch_size   = 256 #files sent to an ExifTool process with each -execute
+exift_stats        = []  #(files, seconds) of each ExifTool process
+fast_stats         = [0, 0] #files read by --fast-exif and files it passed to ExifTool
+fast_ext           = {".jpg", ".jpeg", ".tif", ".tiff"} #files read by --fast-exif, the other formats are read by ExifTool
+fast_types         = {1: "B", 2: "s", 3: "H", 4: "I", 5: "II", 6: "b", 7: "s", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d", 13: "I"} #struct format of the TIFF types
+fast_orientation   = ["Horizontal (normal)", "Mirror horizontal", "Rotate 180", "Mirror vertical", "Mirror horizontal and rotate 270 CW", "Rotate 90 CW", "Mirror horizontal and rotate 90 CW", "Rotate 270 CW"] #Orientation 1-8 as printed by ExifTool
+simplify_stats     = [0, 0] #vertices of the path lines before and after --simplify
+distance_stats     = [0, 0] #waypoints and seconds of the distance math (part of the .KML stage)
+path_distances     = {}  #distance (meters) of the path of each date measured by kml_path, reused by --export
+export_batch_size  = 65536 #rows of each record batch of --export
+stage_stats        = []  #(stage, wall-clock seconds, CPU seconds, items) of each stage, see stage_start/stage_end
+cache_dir          = None  #persistent cache of thumbnails and .heic conversions (None = disabled)
+cache_hash         = False #True = cache key based on the file content instead of path, size and mtime
+kml_buffer         = 1048576 #write buffer (bytes) of each .KML file
+region_depth       = 20    #maximum depth of the quadtree of the regionated .KML files (--regionate)
+worker_pool        = None  #pool of worker processes kept by --watch for all its updates (None = a new pool for each stage)
+watch_settle       = 2     #seconds without changes before an update of --watch (inotify)
+kmz_files          = {}    #.KMZ file of each kml_type (--kmz), holding doc.kml, thumbnails and .heic conversions
+inotify_mask       = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 #IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+pink_blank         = "https://maps.google.com/mapfiles/kml/paddle/pink-blank.png"
 
 
 #***************** FUNCTIONS *****************
-def welcome():
-	exceptions = 0
+@functools.lru_cache(maxsize=None)
+def exiftool_version():
+	#Version of ExifTool (e.g. "12.70"), None if ExifTool was not found. Probed once per process
 	try:
-		subprocess.check_output(["exiftool", "-ver"]) #check if exiftool is installed
+		return subprocess.check_output(["exiftool", "-ver"]).decode().strip()
 	except:
-		exceptions += 1
-		print ("\n ERROR: exiftool was not found")
-	if platform.system() == "Linux":
-		try:
-			subprocess.check_output(["which", "heif-convert"]) #check if libheif-examples is installed
-		except:
-			exceptions += 1
-			print ("\n ERROR: The package libheif-examples was not found")
+		return None
+
+@functools.lru_cache(maxsize=None)
+def tools_missing():
+	#Errors about the external tools that were not found. Probed once per process
+	missing = []
+	if exiftool_version() is None:
+		missing.append("exiftool was not found")
+	if heic_decoder():
+		pass #.heic files are decoded by pillow-heif
+	elif platform.system() == "Linux":
+		if shutil.which("heif-convert") is None: #check if libheif-examples is installed
+			missing.append("The package libheif-examples was not found")
+	elif shutil.which("magick") is None: #check if ImageMagick is installed
+		missing.append("ImageMagick was not found")
+	return tuple(missing)
+
+def arguments_parser(query=False):
+	#Options of the command line, also the options of run() (same names and defaults). query: options of the query subcommand
+	if query:
+		parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + " query", description="Create a Google Earth KML file from the waypoints saved by --store, selected by time and position")
+		parser.add_argument("path", help="path analyzed by a previous run with --store, the output files are saved there")
+		parser.add_argument("--from", dest="time_from", metavar="TIME", help="first timestamp: YYYY, YYYY-MM, YYYY-MM-DD, YYYY-MM-DD HH:MM or YYYY-MM-DD HH:MM:SS (local time, like the EXIF timestamps)")
+		parser.add_argument("--to", dest="time_to", metavar="TIME", help="last timestamp, same formats: the whole period is included (e.g. 2019-06 ends on 2019-06-30 23:59:59)")
+		parser.add_argument("--bbox", nargs=4, type=float, metavar=("NORTH","SOUTH","EAST","WEST"), help="bounding box in decimal degrees (EAST < WEST if it crosses the 180th meridian)")
+		parser.add_argument("--radius", nargs=3, type=float, metavar=("LAT","LONG","METERS"), help="circle around a position in decimal degrees")
+		parser.set_defaults(query=True, no_index=False, utc=False, fast_exif=False, sort_buffer=1000000, partition=None, watch=False, watch_interval=10, watch_poll=False, store=False)
 	else:
+		parser = argparse.ArgumentParser(description="Create a Google Earth KML file from geotagged photos and videos")
+		parser.add_argument("path", help="absolute path to analyze (searched recursively)")
+		parser.set_defaults(query=False)
+	parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, metavar="N", help="number of ExifTool processes and of worker processes used to create the thumbnails (default: number of CPUs)")
+	parser.add_argument("--cache-dir", default="geotag2kml_cache", metavar="DIR", help="directory of the persistent cache of thumbnails and .heic conversions (default: geotag2kml_cache under the given path)")
+	parser.add_argument("--cache-size", type=int, default=2048, metavar="MB", help="maximum size of the cache, the least recently used files are deleted (default: 2048)")
+	parser.add_argument("--cache-hash", action="store_true", help="identify the cached files by the SHA-256 of their content instead of path, size and mtime")
+	parser.add_argument("--no-cache", action="store_true", help="don't use the persistent cache")
+	if not query:
+		parser.add_argument("--no-index", action="store_true", help="scan all the files with ExifTool instead of only the files that are new or changed since the last run")
+		parser.add_argument("--utc", action="store_true", help="convert the timestamps that have a UTC offset (e.g. CreationDate of .mov files) to UTC, the others are kept in local time")
+		parser.add_argument("--fast-exif", action="store_true", help="read the metadata of .jpg and .tif files in-process (pool of --jobs processes) instead of with ExifTool, only the other formats and the files it can't parse are sent to ExifTool")
+		parser.add_argument("--sort-buffer", type=int, default=1000000, metavar="ROWS", help="rows sorted in memory, bigger cases are sorted on disk (default: 1000000)")
+	parser.add_argument("--kmz", action="store_true", help="save each .KML file, its thumbnails and the .heic conversions in a single .KMZ file")
+	parser.add_argument("--regionate", action="store_true", help="split the waypoints in tiles (quadtree) loaded by Google Earth only when they are visible, for cases with too many placemarks")
+	parser.add_argument("--region-size", type=int, default=500, metavar="N", help="maximum number of placemarks in a tile of --regionate (default: 500)")
+	parser.add_argument("--simplify", type=float, metavar="METERS", help="simplify the path lines (Douglas-Peucker) with the given tolerance in meters, the distance traveled is still measured on all the waypoints (Requires: NumPy)")
+	parser.add_argument("--cluster", type=float, metavar="METERS", help="merge the waypoints of the same date taken within METERS and --cluster-time of each other in a single placemark, only its first waypoint gets a thumbnail")
+	parser.add_argument("--cluster-time", type=float, default=10, metavar="MINUTES", help="time window of --cluster between two consecutive waypoints of a cluster (default: 10)")
+	parser.add_argument("--export", action="append", choices=["parquet","arrow","geojson"], help="also export the normalized waypoints and the statistics of the path of each date: Parquet or Arrow IPC files (Requires: PyArrow), or newline-delimited GeoJSON. Can be repeated")
+	if not query:
+		parser.add_argument("--partition", choices=["device","source","year"], help="split the waypoints by device (make and model), top-level folder of the given path or year, and build each partition (thumbnails, .KML files) in a separate process. The main .KML files link the .KML files of the partitions")
+		parser.add_argument("--store", action="store_true", help="also save the waypoints in a binary store with a time and a space index (geotag2kml_store under the given path), queried in milliseconds by the query subcommand (Requires: NumPy)")
+		parser.add_argument("--watch", action="store_true", help="keep running and update the .KML files when files are added, changed or removed: only the new files are scanned and only the dates that changed are written again, each date in its own .KML file (Ctrl+C to stop)")
+		parser.add_argument("--watch-interval", type=float, default=10, metavar="SECONDS", help="seconds between two checks of --watch without inotify, and between two reloads of the dates by Google Earth (default: 10)")
+		parser.add_argument("--watch-poll", action="store_true", help="--watch checks the files every --watch-interval seconds instead of using inotify (e.g. network shares, where inotify doesn't see the changes)")
+	parser.add_argument("--stats-json", metavar="FILE", help="save the wall-clock time, CPU time, items and throughput of each stage and the peak memory in a JSON file")
+	parser.add_argument("--profile", action="store_true", help="profile the creation of the .KML files with cProfile, saved in <timestamp>_kml.prof (slower)")
+	parser.add_argument("--distance", choices=["geodesic","haversine"], default="geodesic", help="how the distance traveled is measured: geodesic (default, geopy) or haversine (NumPy, faster and less precise)")
+	return parser
+
+def arguments_check(run_args):
+	#Error about the values of the options, None if they are valid
+	if run_args.jobs < 1:
+		return "--jobs must be at least 1"
+	if run_args.sort_buffer < 1:
+		return "--sort-buffer must be at least 1"
+	if run_args.region_size < 1:
+		return "--region-size must be at least 1"
+	if run_args.cluster is not None and run_args.cluster <= 0:
+		return "--cluster must be greater than 0"
+	if run_args.cluster_time < 0:
+		return "--cluster-time can't be negative"
+	if run_args.simplify is not None and run_args.simplify <= 0:
+		return "--simplify must be greater than 0"
+	if run_args.watch_interval <= 0:
+		return "--watch-interval must be greater than 0"
+	if run_args.watch and (run_args.kmz or run_args.regionate or run_args.partition or run_args.export or run_args.store):
+		return "--watch can't be used with --kmz, --regionate, --partition, --export or --store"
+	if run_args.query:
+		if run_args.bbox is not None and run_args.radius is not None:
+			return "--bbox and --radius can't be used together"
+		if run_args.radius is not None and run_args.radius[2] <= 0:
+			return "the radius must be greater than 0"
 		try:
-			subprocess.check_output(["magick", "-help"]) #check if ImageMagick is installed
-		except:
-			exceptions += 1
-			print ("\n ERROR: ImageMagick was not found")
-	if exceptions > 0:
+			for query_text in (run_args.time_from, run_args.time_to):
+				if query_text is not None:
+					query_time(query_text)
+		except ValueError:
+			return "invalid time: %s (formats: YYYY, YYYY-MM, YYYY-MM-DD, YYYY-MM-DD HH:MM, YYYY-MM-DD HH:MM:SS)" % query_text
+	return None
+
+def welcome():
+	missing = tools_missing()
+	for error in missing:
+		print ("\n ERROR: " + error)
+	if missing:
 		print ("\n")
 		sys.exit()
 	if len(sys.argv) == 1:
 		print ("\n geotag2kml (v%s)" % version)
-		exift_ver = os.popen("exiftool -ver").read()
-		if float(exift_ver) < 10.80:
+		if float(exiftool_version()) < 10.80:
 			print ("\n !! It's recommended to use a more recent version of ExifTool !!\n")
 		print ("\n This script will create a Google Earth KML file from geotagged photos and videos")
-		print ("\n How to use:\n\n ==> python3 " + os.path.basename(sys.argv[0]) + " AbsolutePathToAnalyze")
+		print ("\n How to use:\n\n ==> python3 " + os.path.basename(sys.argv[0]) + " AbsolutePathToAnalyze [options]")
 		print ("\n [The script will search recursively                 ]")
-		print (" [The output files will be saved under the given path]\n\n")
+		print (" [The output files will be saved under the given path]")
+		print (" [Use -h to list the available options              ]\n\n")
+		sys.exit()
+	query  = sys.argv[1] == "query" #query subcommand
+	parser = arguments_parser(query)
+	args   = parser.parse_args(sys.argv[2:] if query else None)
+	error  = arguments_check(args)
+	if error is not None:
+		parser.error(error)
+	if (args.distance == "haversine" or args.simplify is not None or args.store or args.query) and importlib.util.find_spec("numpy") is None:
+		print ("\n ERROR: NumPy is required by --distance haversine, --simplify, --store and query\n")
+		sys.exit()
+	if set(args.export or []) & {"parquet", "arrow"} and importlib.util.find_spec("pyarrow") is None:
+		print ("\n ERROR: PyArrow is required by --export parquet and --export arrow\n")
 		sys.exit()
-	elif len(sys.argv) == 2:
-		if os.path.exists(sys.argv[1]) == True:
-			os.chdir(sys.argv[1])
+	if os.path.exists(args.path) == False:
+		print ("\n ERROR: the path %s doesn't exist" % args.path)
+		sys.exit()
+	if args.query and os.path.exists(os.path.join(args.path, store_dir, "meta.json")) == False:
+		print ("\n ERROR: no store under %s, run the script with --store first\n" % args.path)
+		sys.exit()
+	return args
+
+def options(path, **run_options):
+	#Options of run(), e.g. options("/cases/1", jobs=4, kmz=True): same names and defaults as the command line options.
+	#Raises an exception instead of exiting like welcome()
+	missing = tools_missing()
+	if missing:
+		raise RuntimeError(", ".join(missing))
+	run_args = arguments_parser(run_options.get("query", False)).parse_args(["--", os.path.abspath(path)])
+	for option, value in run_options.items():
+		if not hasattr(run_args, option):
+			raise TypeError("unknown option: %s" % option)
+		setattr(run_args, option, value)
+	error = arguments_check(run_args)
+	if error is not None:
+		raise ValueError(error)
+	if (run_args.distance == "haversine" or run_args.simplify is not None or run_args.store or run_args.query) and importlib.util.find_spec("numpy") is None:
+		raise ImportError("NumPy is required by --distance haversine, --simplify, --store and query")
+	if set(run_args.export or []) & {"parquet", "arrow"} and importlib.util.find_spec("pyarrow") is None:
+		raise ImportError("PyArrow is required by --export parquet and --export arrow")
+	if not os.path.isdir(run_args.path):
+		raise FileNotFoundError("the path %s doesn't exist" % run_args.path)
+	if run_args.query and not os.path.exists(os.path.join(run_args.path, store_dir, "meta.json")):
+		raise FileNotFoundError("no store under %s, run with store=True first" % run_args.path)
+	return run_args
+
+def stage_start():
+	#Wall-clock time and CPU time at the beginning of a stage. The CPU time includes the child processes that have ended
+	#(ExifTool processes, worker pools), on Windows only the script itself is counted
+	cpu = os.times()
+	return time.perf_counter(), cpu.user + cpu.system + cpu.children_user + cpu.children_system
+
+def stage_end(stage, stage_started, items):
+	#Record the wall-clock time, the CPU time and the number of items processed by a stage started with stage_start()
+	wall_end, cpu_end = stage_start()
+	stage_stats.append((stage, wall_end - stage_started[0], cpu_end - stage_started[1], items))
+
+def peak_rss():
+	#Peak resident set size (MB) of the script and of the biggest child process, (None, None) if it can't be measured (Windows)
+	try:
+		import resource
+	except ImportError:
+		return None, None
+	rss_unit = 1048576 if platform.system() == "Darwin" else 1024 #ru_maxrss is in bytes on macOS, in kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / rss_unit
+
+def stages_json(json_path, duration):
+	#Save the duration of the stages in a JSON file (--stats-json)
+	rss_script, rss_children = peak_rss()
+	stats = {"version": version, "path": args.path, "duration_s": duration, "waypoints": numlines,
+		"peak_rss_mb": {"script": rss_script, "children": rss_children},
+		"stages": [{"stage": stage, "wall_s": wall, "cpu_s": cpu, "items": items, "items_per_s": items / wall if wall > 0 else None} for stage, wall, cpu, items in stage_stats]}
+	with open(json_path, 'w') as w:
+		json.dump(stats, w, indent=1)
+
+@functools.lru_cache(maxsize=None)
+def exiftool_extensions():
+	#File extensions recognized by ExifTool. When a folder is given, ExifTool only processes these files
+	try:
+		exift_listr = subprocess.check_output(["exiftool", "-listr"]).decode("utf-8", "replace")
+	except:
+		return None
+	return set(("." + ext).lower() for ext in exift_listr.split(":", 1)[-1].split())
+
+def output_name(name):
+	#True for the files and folders written by the script at the top of the given path: the outputs of every run (thumbnails and
+	#.heic conversions copy the GPS tags of the original files), the index, the cache and the store (geotag2kml_*).
+	#Only the exact names of the outputs: files of the case named after a timestamp (e.g. 20190601_103000_001.jpg) are scanned
+	return output_pattern.fullmatch(name) is not None or name.startswith("geotag2kml_")
+
+def folder_skipped(root, name):
+	#True for the folders that are not scanned: hidden folders, the cache folder and the output folders of this and of the
+	#previous runs (e.g. the thumbnails of --watch, created while the path is still scanned)
+	return name.startswith(".") or (cache_dir is not None and os.path.abspath(os.path.join(root, name)) == cache_dir) or (root == "." and output_name(name))
+
+def files_walk(exift_ext):
+	#Yield (path, size, mtime) of the files that "exiftool -r *" would process: hidden folders, hidden files
+	#in the given path, the cache folder and the output files of the runs are skipped
+	for root, dirs, files in os.walk("."):
+		dirs[:] = sorted(d for d in dirs if not folder_skipped(root, d))
+		for name in sorted(files):
+			if root == "." and (name.startswith(".") or output_name(name)):
+				continue
+			if exift_ext is not None and os.path.splitext(name)[1].lower() not in exift_ext:
+				continue
+			path = os.path.relpath(os.path.join(root, name)).replace(os.sep, "/")
+			try:
+				file_stat = os.stat(path)
+			except OSError:
+				continue
+			yield path, file_stat.st_size, file_stat.st_mtime_ns
+
+def exiftool_worker(exift_batches, exift_results, exift_tags):
+	#A long-running "exiftool -stay_open True -@ -" process that takes batches of files from a shared queue until it's empty.
+	#The rows (list of columns) of the geotagged files of each batch are put in exift_results, None when the worker is done.
+	#Returns the number of files processed and the duration
+	worker_start = time.time()
+	worker_files = 0
+	try:
+		exift_args = ["-q", "-charset", "filename=utf8", "-if", "defined $gpslongitude", "-T"] + exift_tags.split()
+		exift_proc = subprocess.Popen(["exiftool", "-stay_open", "True", "-@", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding="utf-8", errors="replace")
+		while True:
+			try:
+				exift_batch = exift_batches.get_nowait()
+			except queue.Empty:
+				break
+			exift_proc.stdin.write("\n".join(exift_args + exift_batch + ["-execute"]) + "\n")
+			exift_proc.stdin.flush()
+			rows = []
+			for line in iter(exift_proc.stdout.readline, ""):
+				line = line.rstrip("\r\n")
+				if line == "{ready}": #end of the output of the batch
+					break
+				if line.count("\t") == len(temp_columns) - 1:
+					rows.append(line.split("\t"))
+			exift_results.put(rows)
+			worker_files += len(exift_batch)
+		exift_proc.stdin.write("-stay_open\nFalse\n")
+		exift_proc.stdin.flush()
+		exift_proc.wait()
+	finally:
+		exift_results.put(None)
+	return worker_files, time.time() - worker_start
+
+def exiftool_extract(paths, exift_tags):
+	#Run ExifTool on a list of files, split in batches shared by "args.jobs" ExifTool processes running in parallel.
+	#Yield the rows (list of columns) of the geotagged files as soon as each batch is done. The results queue is bounded,
+	#so the workers wait if the rows are not consumed. If the caller stops (or fails) before the end, the batches left are
+	#dropped and the results drained, so each worker ends after its current batch instead of waiting on the full queue forever
+	exift_batches = queue.Queue()
+	for i in range(0, len(paths), exift_batch_size):
+		exift_batches.put(paths[i:i+exift_batch_size])
+	exift_workers = min(args.jobs, exift_batches.qsize())
+	exift_results = queue.Queue(maxsize=exift_workers * 2 + 1)
+	with ThreadPoolExecutor(max_workers=max(exift_workers, 1)) as executor:
+		workers = [executor.submit(exiftool_worker, exift_batches, exift_results, exift_tags) for worker_id in range(exift_workers)]
+		workers_running = exift_workers
+		try:
+			while workers_running > 0:
+				rows = exift_results.get()
+				if rows is None:
+					workers_running -= 1
+				else:
+					yield from rows
+		finally:
+			try:
+				while True:
+					exift_batches.get_nowait()
+			except queue.Empty:
+				pass
+			while workers_running > 0:
+				if exift_results.get() is None:
+					workers_running -= 1
+		for worker in workers:
+			exift_stats.append(worker.result())
+
+def fast_ifd(read, order, offset):
+	#Entries of a TIFF IFD: {tag: (type, count, value)}. Values of more than 4 bytes are read at their offset
+	entry_count = struct.unpack(order + "H", read(offset, 2))[0]
+	entry_data  = read(offset + 2, entry_count * 12)
+	entries     = {}
+	for entry in range(entry_count):
+		tag, tag_type, count, value = struct.unpack(order + "HHI4s", entry_data[entry*12:entry*12+12])
+		if tag_type not in fast_types:
+			continue
+		size = struct.calcsize(order + fast_types[tag_type]) * count
+		if size > 4:
+			value = read(struct.unpack(order + "I", value)[0], size)
+		entries[tag] = (tag_type, count, value[:size])
+	return entries
+
+def fast_value(order, entry):
+	#Value of an IFD entry: stripped string (ASCII), bytes (UNDEFINED), list of numbers (rationals as floats,
+	#ZeroDivisionError if undefined)
+	tag_type, count, value = entry
+	if tag_type == 2:
+		return value.split(b"\0", 1)[0].decode("utf-8", "replace").strip()
+	if tag_type == 7:
+		return value
+	numbers = struct.unpack(order + fast_types[tag_type] * count, value)
+	if tag_type in (5, 10):
+		return [numbers[i] / numbers[i+1] for i in range(0, len(numbers), 2)]
+	return list(numbers)
+
+def fast_read(path):
+	#Read the tags of exift_tags from a .jpg or .tif file without ExifTool, printed as "exiftool -T" would print them.
+	#Only the metadata are read: the APP1 segment and the SOF marker of a JPEG file, the IFDs of a TIFF file.
+	#Returns the columns of temp_columns, None if the file isn't geotagged. Raises an exception if the file must be read by
+	#ExifTool: unknown structure, undefined rationals, or GPS/date tags missing from EXIF when they may be in XMP
+	with open(path, 'rb') as f:
+		head = f.read(4)
+		if head[:2] == b"\xff\xd8": #JPEG: APP1 "Exif" segment, then the size of the image in the SOF marker
+			f.seek(2)
+			tiff = None
+			xmp  = False
+			size = None
+			while size is None:
+				marker, length = struct.unpack(">HH", f.read(4))
+				if marker in (0xffc0, 0xffc1, 0xffc2, 0xffc3, 0xffc5, 0xffc6, 0xffc7, 0xffc9, 0xffca, 0xffcb, 0xffcd, 0xffce, 0xffcf):
+					height, width = struct.unpack(">xHH", f.read(5))
+					size = [width, height]
+				elif marker == 0xffda or marker >> 8 != 0xff: #image data without SOF, or not a marker
+					raise ValueError("JPEG size not found")
+				elif marker == 0xffe1 and length > 8:
+					segment = f.read(length - 2)
+					if segment[:6] == b"Exif\0\0" and tiff is None:
+						tiff = segment[6:]
+					elif segment.startswith(b"http://ns.adobe.com/xap/"):
+						xmp = True
+				else:
+					f.seek(length - 2, 1)
+			if tiff is None:
+				if xmp:
+					raise ValueError("XMP without EXIF")
+				return None
+			read = lambda offset, length: tiff[offset:offset+length]
+		elif head in (b"II*\0", b"MM\0*"): #TIFF: the IFDs are read where they are
+			size = None
+			xmp  = None
+			def read(offset, length):
+				f.seek(offset)
+				return f.read(length)
 		else:
-			print ("\n ERROR: the path %s doesn't exist") % sys.argv[1]
-			sys.exit()
+			raise ValueError("not a JPEG or TIFF file")
+		order = "<" if read(0, 2) == b"II" else ">"
+		ifd0  = fast_ifd(read, order, struct.unpack(order + "I", read(4, 4))[0])
+		exif  = fast_ifd(read, order, fast_value(order, ifd0[0x8769])[0]) if 0x8769 in ifd0 else {}
+		gps   = fast_ifd(read, order, fast_value(order, ifd0[0x8825])[0]) if 0x8825 in ifd0 else {}
+		if xmp is None:
+			xmp = 0x02bc in ifd0 #XMP of a TIFF file
+		if 4 not in gps: #-if "defined $gpslongitude"
+			if xmp:
+				raise ValueError("GPS may be in XMP")
+			return None
+		if xmp and not (0x9003 in exif and 2 in gps):
+			raise ValueError("tags may be in XMP")
+		if size is None:
+			size = [fast_value(order, ifd0[tag])[0] if tag in ifd0 else "-" for tag in (0x0100, 0x0101)]
+	#same conversions as ExifTool: signed degrees (Composite:GPSLatitude/GPSLongitude), altitude truncated to 0.1 m
+	#(Composite:GPSAltitude), numbers printed with 15 significant digits
+	coordinates = []
+	for ref_tag, tag, negative in ((1, 2, "S"), (3, 4, "W")):
+		if tag not in gps:
+			coordinates.append("-")
+			continue
+		dms    = fast_value(order, gps[tag]) + [0, 0]
+		degree = dms[0] + (dms[1] + dms[2] / 60) / 60
+		if ref_tag in gps and fast_value(order, gps[ref_tag]).upper().startswith(negative):
+			degree = -degree
+		coordinates.append("%.15g" % degree)
+	altitude = "-"
+	if 6 in gps:
+		meters = math.trunc(fast_value(order, gps[6])[0] * 10) / 10
+		if 5 in gps and fast_value(order, gps[5])[:1] in ([1], b"\x01"):
+			meters = -meters
+		altitude = "%.15g m %s Sea Level" % (abs(meters), "Below" if meters < 0 else "Above")
+	orientation = "-"
+	if 0x0112 in ifd0:
+		orientation_value = fast_value(order, ifd0[0x0112])[0]
+		orientation = fast_orientation[orientation_value - 1] if 1 <= orientation_value <= 8 else "Unknown (%d)" % orientation_value
+	tags = [fast_value(order, ifd[tag]) if tag in ifd else "-" for ifd, tag in ((exif, 0x9003), (exif, 0x9004), ({}, None), (ifd0, 0x0132))]
+	directory, filename = posixpath.split(path)
+	return tags + [filename, directory or "."] + coordinates + [altitude] + [fast_value(order, ifd0[tag]) if tag in ifd0 else "-" for tag in (0x010f, 0x0110)] + [orientation] + [str(value) for value in size]
+
+def fast_batch(paths):
+	#--fast-exif: read a batch of files in a worker process. For each file: its columns, None if it isn't geotagged,
+	#False if it must be read by ExifTool
+	fast_rows = []
+	for path in paths:
+		try:
+			fast_rows.append(fast_read(path))
+		except Exception:
+			fast_rows.append(False)
+	return fast_rows
+
+def metadata_extract(paths, exift_tags):
+	#Yield the rows (list of columns) of the geotagged files among paths. With --fast-exif the .jpg and .tif files are read
+	#in-process by a pool of "args.jobs" processes, ExifTool reads the other files and the ones the fast path couldn't parse
+	if not args.fast_exif:
+		yield from exiftool_extract(paths, exift_tags)
+		return
+	exift_paths = [path for path in paths if os.path.splitext(path)[1].lower() not in fast_ext]
+	fast_paths  = [path for path in paths if os.path.splitext(path)[1].lower() in fast_ext]
+	fast_jobs   = [fast_paths[i:i+exift_batch_size] for i in range(0, len(fast_paths), exift_batch_size)]
+	executor    = None
+	if worker_pool is not None:
+		fast_results = worker_pool.map(fast_batch, fast_jobs)
+	elif args.jobs > 1 and len(fast_jobs) > 1:
+		executor     = ProcessPoolExecutor(max_workers=min(args.jobs, len(fast_jobs)))
+		fast_results = executor.map(fast_batch, fast_jobs)
+	else:
+		fast_results = map(fast_batch, fast_jobs)
+	try:
+		for fast_job, fast_rows in zip(fast_jobs, fast_results):
+			for path, columns in zip(fast_job, fast_rows):
+				if columns is False:
+					exift_paths.append(path)
+				elif columns is not None:
+					yield columns
+			fast_stats[0] += len(fast_job)
+	finally:
+		#also when the caller stops early or a batch fails: the batches not started yet are cancelled and the pool is shut down
+		if worker_pool is not None or executor is not None:
+			fast_results.close()
+		if executor is not None:
+			executor.shutdown()
+	fast_stats[1] = len(exift_paths) - (len(paths) - len(fast_paths))
+	yield from exiftool_extract(exift_paths, exift_tags)
+
+def metadata_index(file_temp, exift_tags):
+	#INCREMENTAL METADATA INDEX: the metadata extracted by ExifTool are stored in a SQLite database under the given path.
+	#Only the files that are new or changed (size or mtime) since the last run are sent to ExifTool.
+	#Returns the number of files scanned by ExifTool and the number of files removed from the index
+	if args.no_index:
+		paths = [path for path, size, mtime in files_walk(exiftool_extensions())]
+		with open(file_temp, 'a') as w:
+			for column in metadata_extract(paths, exift_tags):
+				w.write("\t".join(column) + "\n")
+		return len(paths), 0
+	db = sqlite3.connect(index_file)
+	db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+	db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, geotagged INTEGER, %s)" % ", ".join("%s TEXT" % column for column in temp_columns))
+	#the index is rebuilt if ExifTool, the extracted tags or the reader of the .jpg/.tif files (--fast-exif) change
+	index_key = "%s|%s%s" % (exiftool_version(), exift_tags, "|fast" if args.fast_exif else "")
+	index_row = db.execute("SELECT value FROM info WHERE key='index_key'").fetchone()
+	if index_row is None or index_row[0] != index_key:
+		db.execute("DELETE FROM files")
+		db.execute("INSERT OR REPLACE INTO info VALUES ('index_key', ?)", (index_key,))
+	
+	indexed    = {path: (size, mtime) for path, size, mtime in db.execute("SELECT path, size, mtime FROM files")}
+	scan_files = {}
+	for path, size, mtime in files_walk(exiftool_extensions()):
+		if indexed.pop(path, None) != (size, mtime):
+			scan_files[path] = (size, mtime)
+	db.executemany("DELETE FROM files WHERE path=?", ((path,) for path in indexed)) #files that don't exist anymore
+	
+	db.executemany("INSERT OR REPLACE INTO files (path, size, mtime, geotagged) VALUES (?,?,?,0)", ((path, size, mtime) for path, (size, mtime) in scan_files.items()))
+	db.executemany("UPDATE files SET geotagged=1, %s WHERE path=?" % ", ".join("%s=?" % column for column in temp_columns),
+		(tuple(column) + (posixpath.normpath(column[5] + "/" + column[4]),) for column in metadata_extract(list(scan_files), exift_tags))) #Directory/Filename
+	db.commit()
+	
+	with open(file_temp, 'a') as w:
+		for row in db.execute("SELECT %s FROM files WHERE geotagged=1" % ", ".join(temp_columns)):
+			w.write("\t".join(row) + "\n")
+	db.close()
+	return len(scan_files), len(indexed)
+
+def temp_rows(file_temp):
+	#Yield the rows of the ExifTool output as they are (tab-separated temp_columns, without newline). A chunk of rows to sort is kept
+	#in memory as these strings, the columns are split only when they are needed: a tuple of columns would take several times the
+	#memory of the row. Rows without both coordinates (e.g. GPSLongitude without GPSLatitude) are skipped, they can't be placed on the map
+	with open(file_temp) as r:
+		next(r) #skip the header row
+		for row in r:
+			row    = row.rstrip("\n")
+			column = row.split("\t")
+			if len(column) == len(temp_columns) and number_parse(column[6]) is not None and number_parse(column[7]) is not None:
+				yield row
+
+def row_path(row):
+	#Directory/Filename of a row of the ExifTool output
+	column = row.split("\t", 6)
+	return column[5] + "/" + column[4]
+
+def timestamp_value(text):
+	#"YYYY:MM:DD HH:MM:SS[.ss][+HH:MM|Z]" -> (milliseconds since 1970-01-01 of the local time, UTC offset in minutes or None),
+	#(None, None) if the timestamp is missing or malformed (e.g. 0000:00:00 00:00:00). Same result as timestamps_array
+	match = timestamp_pattern.match(text)
+	if match is None:
+		return None, None
+	try:
+		local = datetime(*[int(value) for value in match.groups()[:6]])
+	except ValueError:
+		return None, None
+	milliseconds = (local - datetime(1970, 1, 1)) // timedelta(milliseconds=1) + int((match.group(7) or "0")[:3].ljust(3, "0"))
+	utc_offset   = match.group(8)
+	if utc_offset is not None:
+		utc_offset = 0 if utc_offset == "Z" else (-1 if utc_offset[0] == "-" else 1) * (int(utc_offset[1:3]) * 60 + int(utc_offset[-2:]))
+	return milliseconds, utc_offset
+
+def timestamps_array(texts):
+	#timestamp_value of a whole column with NumPy: the characters of the timestamps are checked and converted as a matrix of code
+	#points, the subseconds and the UTC offset only for the timestamps that have them. Returns the milliseconds (store_nat if missing
+	#or malformed), the UTC offsets in minutes, where they are present and which timestamps are written as "YYYY:MM:DD HH:MM:SS"
+	import numpy as np
+	count  = len(texts)
+	chars  = np.array(texts, dtype="U40").view(np.uint32).reshape(count, 40)
+	digits = chars[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]].astype(np.int64) - 48
+	pairs  = digits[:, 0::2] * 10 + digits[:, 1::2]
+	year, month, day, hour, minute, second = pairs[:, 0] * 100 + pairs[:, 1], pairs[:, 2], pairs[:, 3], pairs[:, 4], pairs[:, 5], pairs[:, 6]
+	valid  = ((digits >= 0) & (digits <= 9)).all(axis=1) & np.isin(chars[:, 4], (58, 45)) & np.isin(chars[:, 7], (58, 45)) & np.isin(chars[:, 10], (32, 84)) & (chars[:, 13] == 58) & (chars[:, 16] == 58)
+	valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & (minute < 60) & (second < 60)
+	months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype("datetime64[M]")
+	days   = months.astype("datetime64[D]") + np.where(valid, day - 1, 0).astype("timedelta64[D]")
+	valid &= days.astype("datetime64[M]") == months #e.g. February 30
+	milliseconds = days.astype("datetime64[ms]").astype(np.int64) + ((hour * 60 + minute) * 60 + second) * 1000
+	utc_offset   = np.zeros(count, dtype=np.int64)
+	has_offset   = np.zeros(count, dtype=bool)
+	suffixed     = np.flatnonzero(valid & (chars[:, 19] != 0))
+	if len(suffixed) > 0:
+		suffix = chars[suffixed]
+		digit  = (suffix >= 48) & (suffix <= 57)
+		#subseconds: "." and at least a digit, only the milliseconds are kept
+		fraction        = np.logical_and.accumulate(digit[:, 20:], axis=1) & (suffix[:, 19:20] == 46)
+		fraction_digits = fraction.sum(axis=1)
+		milliseconds[suffixed] += sum(np.where(fraction[:, i], suffix[:, 20 + i].astype(np.int64) - 48, 0) * 10**(2 - i) for i in range(3))
+		#UTC offset after the subseconds: "Z", "+HH:MM" or "+HHMM"
+		rows   = np.arange(len(suffixed))
+		start  = 19 + np.where(fraction_digits > 0, fraction_digits + 1, 0)
+		at     = lambda shift: np.minimum(start + shift, 39)
+		number = lambda *shifts: sum((suffix[rows, at(shift)].astype(np.int64) - 48) * 10**(len(shifts) - 1 - i) for i, shift in enumerate(shifts))
+		sign   = suffix[rows, at(0)]
+		colon  = suffix[rows, at(3)] == 58
+		offset = (start + 5 < 40) & np.isin(sign, (43, 45)) & digit[rows, at(1)] & digit[rows, at(2)] & np.where(colon, digit[rows, at(4)] & digit[rows, at(5)], digit[rows, at(3)] & digit[rows, at(4)])
+		offset_minutes = number(1, 2) * 60 + np.where(colon, number(4, 5), number(3, 4))
+		utc_offset[suffixed] = np.where(offset, np.where(sign == 45, -offset_minutes, offset_minutes), 0)
+		has_offset[suffixed] = offset | (sign == 90)
+	canonical = valid & (chars[:, 4] == 58) & (chars[:, 7] == 58) & (chars[:, 10] == 32)
+	return np.where(valid, milliseconds, store_nat), utc_offset, has_offset, canonical
+
+def timestamp_text(row, column, milliseconds, has_offset, is_mov):
+	#Timestamp column of a row of the CSV sorted by Timestamp when it isn't the chosen value as it is: no valid timestamp (the first
+	#one that is present), converted to UTC (--utc), other separators (2019-06-01T08:00:00 -> 2019:06:01 08:00:00)
+	if column < 0:
+		return next((row[temp_columns.index(field)] for field in timestamp_fields[is_mov] if len(row[temp_columns.index(field)]) > 1), "-")
+	if args.utc and has_offset:
+		return (datetime(1970, 1, 1) + timedelta(milliseconds=milliseconds)).strftime("%Y:%m:%d %H:%M:%S") + (".%03d" % (milliseconds % 1000) if milliseconds % 1000 else "") + "Z"
+	timestamp = row[column]
+	return timestamp[:4] + ":" + timestamp[5:7] + ":" + timestamp[8:10] + " " + timestamp[11:]
+
+def timestamps_chunk(rows):
+	#Choose the Timestamp of a chunk of rows of the ExifTool output (see temp_rows): the first valid timestamp in the order of
+	#timestamp_fields, the first one that is present if none is valid. With --utc the timestamps with a UTC offset are converted to UTC.
+	#The rows are sorted by (timestamp, device, path), stable, the rows without a valid timestamp first. NumPy parses (timestamps_slice
+	#rows at a time) and sorts the whole chunk if it's installed. Returns the sort keys (milliseconds) and the rows of the CSV sorted
+	#by Timestamp, in order. The rows of the chunk are replaced by the rows of the CSV, so only one copy of the chunk is in memory
+	columns    = {field: temp_columns.index(field) for field in timestamp_fields[False]}
+	movs       = []
+	devices    = []
+	device_ids = {} #(Make, Model) -> id, the devices are ranked once sorted
+	for row in rows:
+		column = row.split("\t", 11)
+		movs.append(column[4][-4:].lower() == ".mov")
+		devices.append(device_ids.setdefault((column[9], column[10]), len(device_ids)))
+	device_rank = {device_id: rank for rank, (device, device_id) in enumerate(sorted(device_ids.items()))}
+	devices     = [device_rank[device_id] for device_id in devices]
+	if importlib.util.find_spec("numpy") is not None:
+		import numpy as np
+		mov        = np.array(movs, dtype=bool)
+		ms         = np.full(len(rows), store_nat, dtype=np.int64)
+		chosen     = np.full(len(rows), -1, dtype=np.int64)
+		utc_offset = np.zeros(len(rows), dtype=np.int64)
+		has_offset = np.zeros(len(rows), dtype=bool)
+		canonical  = np.zeros(len(rows), dtype=bool)
+		for is_mov, fields in timestamp_fields.items():
+			for field in fields: #each field is parsed only for the rows without a valid timestamp yet
+				todo = np.flatnonzero((mov == is_mov) & (chosen < 0))
+				if len(todo) == 0:
+					break
+				for todo_slice in range(0, len(todo), timestamps_slice):
+					todo_rows = todo[todo_slice:todo_slice+timestamps_slice]
+					field_ms, field_offset, field_has_offset, field_canonical = timestamps_array([rows[i].split("\t", columns[field] + 1)[columns[field]] for i in todo_rows.tolist()])
+					valid = field_ms != store_nat
+					take  = todo_rows[valid]
+					ms[take], chosen[take], utc_offset[take], has_offset[take], canonical[take] = field_ms[valid], columns[field], field_offset[valid], field_has_offset[valid], field_canonical[valid]
+		if args.utc:
+			ms = np.where(has_offset, ms - utc_offset * 60000, ms)
+			canonical &= ~has_offset
+		rewrite     = np.flatnonzero(~canonical).tolist() #see timestamp_text
+		rank        = np.array(devices, dtype=np.int64)
+		order       = np.lexsort((rank, ms))
+		sorted_ms   = ms[order]
+		sorted_rank = rank[order]
+		tied        = np.concatenate(([0], ((sorted_ms[1:] == sorted_ms[:-1]) & (sorted_rank[1:] == sorted_rank[:-1])).astype(np.int8), [0]))
+		order       = order.tolist()
+		tie_bounds  = np.flatnonzero(np.diff(tied)).tolist()
+		for tie_start, tie_end in zip(tie_bounds[0::2], tie_bounds[1::2]): #same timestamp and device: sorted by path
+			order[tie_start:tie_end+1] = sorted(order[tie_start:tie_end+1], key=lambda i: row_path(rows[i]))
+		sort_keys = sorted_ms.tolist()
+		chosen    = chosen.tolist()
+	else:
+		ms, chosen, has_offset = [], [], []
+		for row, is_mov in zip(rows, movs):
+			column = row.split("\t", 4)
+			for field in timestamp_fields[is_mov]:
+				row_ms, row_offset = timestamp_value(column[columns[field]])
+				if row_ms is not None:
+					ms.append(row_ms - row_offset * 60000 if args.utc and row_offset is not None else row_ms)
+					chosen.append(columns[field])
+					has_offset.append(row_offset is not None)
+					break
+			else:
+				ms.append(store_nat)
+				chosen.append(-1)
+				has_offset.append(False)
+		order     = sorted(range(len(rows)), key=lambda i: (ms[i], devices[i], row_path(rows[i])))
+		sort_keys = [ms[i] for i in order]
+		rewrite   = [i for i, row in enumerate(rows) if chosen[i] < 0 or args.utc and has_offset[i] or row.split("\t", 4)[chosen[i]][4:11:3] != ":: "]
+	#the chosen value as it is, unless timestamp_text has to rewrite it. The rows are created in input order and only then reordered:
+	#reading them in sorted order would jump around the memory
+	rewritten = {i: timestamp_text(rows[i].split("\t"), chosen[i], int(ms[i]), bool(has_offset[i]), movs[i]) for i in rewrite}
+	for i, column in enumerate(chosen):
+		row_columns = rows[i].split("\t", 4)
+		rows[i] = (rewritten[i] if i in rewritten else row_columns[column]) + "\t" + row_columns[4] + "\n"
+	return sort_keys, [rows[i] for i in order]
+
+def rows_key(line):
+	#Sort key of a line of a sorted run: (timestamp prefix, make, model, path), see timestamps_chunk
+	column = line.split("\t", 10)
+	return column[0], column[7], column[8], column[3] + "/" + column[2]
+
+def rows_sorted(rows, sort_buffer):
+	#Yield the rows of the CSV sorted by Timestamp (see timestamps_chunk). Up to sort_buffer rows are sorted in memory, bigger inputs
+	#are sorted in runs of sort_buffer rows spilled to temporary files and then merged (external merge sort), so the memory used is
+	#bounded. Each row of a run starts with its timestamp as a fixed-width number, so the runs are merged by comparing strings
+	sort_runs = []
+	for rows_chunk in iter(lambda: list(itertools.islice(rows, sort_buffer)), []):
+		sort_keys, sorted_rows = timestamps_chunk(rows_chunk)
+		if not sort_runs and len(rows_chunk) < sort_buffer:
+			yield from sorted_rows #everything fits in memory
+			return
+		sort_run = tempfile.TemporaryFile('w+', dir=".")
+		sort_run.writelines("%020d\t%s" % (sort_key - store_nat, row) for sort_key, row in zip(sort_keys, sorted_rows))
+		sort_run.seek(0)
+		sort_runs.append(sort_run)
+	for line in heapq.merge(*sort_runs, key=rows_key):
+		yield line[21:]
+	for sort_run in sort_runs:
+		sort_run.close()
+
+def number_parse(value, number_type=float):
+	#"-" (tag not found) or any other value that is not a number becomes None
+	try:
+		return number_type(value)
+	except ValueError:
+		return None
+
+def altitude_parse(c_alt):
+	#"120.5 m Above Sea Level" -> 120.5, "3 m Below Sea Level" -> -3.0, "-" -> None
+	#https://exiftool.org/faq.html#Q6
+	altitude = number_parse(c_alt.split(" ")[0])
+	if altitude is not None and "Below" in c_alt:
+		altitude = -altitude
+	return altitude
+
+def timestamp_parse(c_ts):
+	#"YYYY:MM:DD HH:MM:SS" (any subseconds or timezone are ignored) -> datetime, None if the timestamp is missing or malformed
+	try:
+		return datetime.strptime(c_ts[:19], "%Y:%m:%d %H:%M:%S")
+	except ValueError:
+		return None
+
+def waypoint_parse(counter_row, row):
+	#Parse a row of the CSV sorted by Timestamp only once. counter_row is the line number of the row in the CSV file.
+	#lat and long are None if a coordinate is missing ("-")
+	column = row.rstrip("\n").split("\t")
+	return Waypoint(counter_row, column[0], timestamp_parse(column[0]), column[1], column[2], number_parse(column[3]), number_parse(column[4]),
+		altitude_parse(column[5]), column[5], column[6], column[7], column[8], number_parse(column[9], int), number_parse(column[10], int))
+
+def waypoints_coordinates(waypoints):
+	#(latitudes, longitudes) of a list of waypoints as NumPy arrays, for the distance math on the whole path (--distance haversine, --simplify)
+	import numpy as np
+	return (np.fromiter((wp.lat for wp in waypoints), dtype=np.float64, count=len(waypoints)),
+		np.fromiter((wp.long for wp in waypoints), dtype=np.float64, count=len(waypoints)))
+
+def exif_rows():
+	#Yield the waypoints of the CSV sorted by Timestamp, reading it sequentially. Waypoints without both coordinates are skipped
+	with open(file_exif) as r:
+		next(r) #skip the header row
+		for counter_row, row in enumerate(r, 2):
+			wp = waypoint_parse(counter_row, row)
+			if wp.lat is not None and wp.long is not None:
+				yield wp
+
+def exif_days():
+	#Yield (YYYY:MM:DD, waypoints) for each date of the CSV sorted by Timestamp. Only the waypoints of one date are kept in memory
+	for date, date_rows in itertools.groupby(exif_rows(), key=lambda wp: wp.ts[:10]):
+		yield date, list(date_rows)
+
+def path_distance(waypoints, coordinates=None):
+	#Length in meters of a path. Each segment between two consecutive waypoints is measured only once.
+	#coordinates: the waypoints_coordinates of the path if the caller already has them
+	if args.distance == "haversine":
+		return path_distance_haversine(*(coordinates or waypoints_coordinates(waypoints)))
+	from geopy.distance import geodesic
+	distance = 0
+	for wp1, wp2 in zip(waypoints, waypoints[1:]):
+		distance += geodesic((wp1.lat,wp1.long),(wp2.lat,wp2.long)).meters #geopy requires: latitude,longitude
+	return distance
+
+def path_distance_haversine(lat, long):
+	#Great-circle distance computed with NumPy over the whole path at once (faster, less precise than geodesic)
+	#https://en.wikipedia.org/wiki/Haversine_formula
+	import numpy as np
+	lat  = np.radians(lat)
+	long = np.radians(long)
+	a = np.sin(np.diff(lat)/2)**2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(long)/2)**2
+	return float(np.sum(2 * earth_radius * np.arcsin(np.sqrt(a))))
+
+def path_simplify(lat, long, tolerance):
+	#Douglas-Peucker: indices of the vertices kept, the simplified path is never farther than tolerance meters from the original one.
+	#The points are projected on a plane (equirectangular, precise enough at the scale of a path), the distances of all the points
+	#of a range from its segment are computed at once with NumPy. The ranges are kept in a stack instead of using recursion
+	#https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
+	import numpy as np
+	y = np.radians(lat) * earth_radius
+	x = np.radians(long) * earth_radius * np.cos(np.radians(np.mean(lat)))
+	keep = np.zeros(len(x), dtype=bool)
+	keep[0] = keep[-1] = True
+	ranges = [(0, len(x) - 1)]
+	while ranges:
+		first, last = ranges.pop()
+		if last - first < 2:
+			continue
+		dx = x[last] - x[first]
+		dy = y[last] - y[first]
+		px = x[first+1:last] - x[first]
+		py = y[first+1:last] - y[first]
+		segment = dx * dx + dy * dy
+		t = np.clip((px * dx + py * dy) / segment, 0, 1) if segment > 0 else 0 #closest point of the segment (not of the line: paths can go back)
+		distance = np.hypot(px - t * dx, py - t * dy)
+		farthest = int(np.argmax(distance))
+		if distance[farthest] > tolerance:
+			farthest += first + 1
+			keep[farthest] = True
+			ranges.append((first, farthest))
+			ranges.append((farthest, last))
+	return np.flatnonzero(keep)
+
+def distance_format(distance):
+	distance1 = round(distance,2)      #meters
+	distance2 = round(distance/1000,2) #km
+	if distance2 < 1:
+		return str(distance1) + " m"  #change to "ft" if needed
+	else:
+		return str(distance2) + " km" #change to "mi" if needed
+
+def thumbs_name(c_fn, counter_row):
+	return c_fn[:c_fn.find(".")].lower() + "_" + str(counter_row)
+
+def heic_name(c_fn, counter_row):
+	return c_fn[:c_fn.find(".")].lower() + "_heic_" + str(counter_row) + ".jpg"
+
+@functools.lru_cache(maxsize=None)
+def heic_decoder():
+	#True if pillow-heif is installed: .heic files are decoded in-process instead of running heif-convert/magick
+	return importlib.util.find_spec("pillow_heif") is not None
+
+def heic_convert(heic_job):
+	#Convert a .heic file to .jpg. It runs in a worker process
+	#https://forensenellanebbia.blogspot.com/2018/09/converting-from-heic-to-jpg.html
+	src_file, dst_file = heic_job
+	try:
+		if heic_decoder():
+			import pillow_heif
+			from PIL import Image
+			pillow_heif.register_heif_opener()
+			with Image.open(src_file) as im:
+				im.convert("RGB").save(dst_file, 'JPEG', quality=90)
+		elif platform.system() == "Linux":
+			subprocess.run(["heif-convert", src_file, dst_file], stdout=subprocess.DEVNULL)
+		else:
+			subprocess.run(["magick", src_file, dst_file], stdout=subprocess.DEVNULL)
+	except:
+		pass
+	return os.path.exists(dst_file)
+
+def heic_metadata(heic_files):
+	#Copy the metadata of the .heic files to the converted .jpg files with a single ExifTool invocation (one argfile, one -execute per command)
+	exift_cmds = []
+	for src_file, dst_file in heic_files:
+		exift_cmds.append(["-all=", "-TagsFromFile", src_file, dst_file])                                #remove metadata from the destination .jpg file
+		exift_cmds.append(["-TagsFromFile", src_file, "-FileModifyDate", "-FileCreateDate", dst_file]) #import metadata from the source .heic file
+	argfile = ptime + "_heic_args.txt"
+	with open(argfile, 'w', encoding="utf-8") as w:
+		w.write("\n-execute\n".join("\n".join(exift_cmd) for exift_cmd in exift_cmds) + "\n")
+	subprocess.run(["exiftool", "-@", argfile, "-common_args", "-q", "-overwrite_original", "-charset", "filename=utf8"])
+	os.remove(argfile)
+
+def heic_conversion(waypoints=None):
+	#Convert the .heic files to .jpg (cache first, then a pool of "args.jobs" processes), then copy their metadata.
+	#waypoints: only these waypoints (default: all the rows of the CSV). Returns the number of .heic files
+	heic_count = 0
+	heic_jobs = []
+	heic_cached = {}
+	for wp in (exif_rows() if waypoints is None else waypoints):
+		if wp.fn.lower().endswith(".heic"):
+			heic_count += 1
+			os.makedirs(prefix_heic, exist_ok=True)
+			src_file = wp.dir + "/" + wp.fn
+			dst_file = prefix_heic + "/" + heic_name(wp.fn, wp.row)
+			try:
+				cached = cache_file(src_file, "heic|" + my_os)
+			except OSError:
+				cached = None
+			if not cache_get(cached, dst_file):
+				heic_jobs.append((src_file, dst_file))
+				heic_cached[dst_file] = cached
+	if not heic_jobs:
+		return heic_count
+	if worker_pool is not None:
+		heic_done = list(worker_pool.map(heic_convert, heic_jobs))
+	elif args.jobs > 1:
+		with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+			heic_done = list(executor.map(heic_convert, heic_jobs))
+	else:
+		heic_done = list(map(heic_convert, heic_jobs))
+	heic_files = [heic_job for heic_job, done in zip(heic_jobs, heic_done) if done]
+	if heic_files:
+		heic_metadata(heic_files)
+	for src_file, dst_file in heic_files:
+		cache_put(dst_file, heic_cached[dst_file])
+	return heic_count
+
+def cache_init(cache_dir_run, cache_hash_run):
+	#Set the cache options. It's also the initializer of the worker processes
+	global cache_dir, cache_hash
+	cache_dir  = cache_dir_run
+	cache_hash = cache_hash_run
+
+def cache_file(src_path, params):
+	#Path of the cached copy of the output created from src_path with the given parameters (None if the cache is disabled).
+	#The key is the source path, size and mtime, or the SHA-256 of its content if --cache-hash is used
+	if cache_dir is None:
+		return None
+	if cache_hash:
+		src_hash = hashlib.sha256()
+		with open(src_path, 'rb') as r:
+			for chunk in iter(lambda: r.read(1048576), b""):
+				src_hash.update(chunk)
+		src_id = src_hash.hexdigest()
+	else:
+		src_stat = os.stat(src_path)
+		src_id   = "%s|%d|%d" % (os.path.abspath(src_path), src_stat.st_size, src_stat.st_mtime_ns)
+	key = hashlib.sha1(("%s|%s" % (src_id, params)).encode("utf-8")).hexdigest()
+	return os.path.join(cache_dir, key[:2], key + ".jpg")
+
+def cache_get(cached, dst_path):
+	#Copy a cached file to dst_path. Returns False if the file is not in the cache
+	if cached is None or not os.path.exists(cached):
+		return False
+	os.utime(cached, (time.time(), os.stat(cached).st_mtime)) #the access time records the last use (LRU), the mtime is part of the cached file
+	try:
+		os.link(cached, dst_path)
+	except OSError:
+		shutil.copy2(cached, dst_path)
+	return True
+
+def cache_read(cached):
+	#Content of a cached file, None if the file is not in the cache
+	if cached is None or not os.path.exists(cached):
+		return None
+	os.utime(cached, (time.time(), os.stat(cached).st_mtime))
+	with open(cached, 'rb') as r:
+		return r.read()
+
+def cache_put(src_file, cached):
+	#Store a copy of src_file (a path, or the content of the file as bytes) in the cache
+	if cached is None or (not isinstance(src_file, bytes) and not os.path.exists(src_file)):
+		return
+	try:
+		os.makedirs(os.path.dirname(cached), exist_ok=True)
+		cached_temp = "%s.%d.tmp" % (cached, os.getpid())
+		if isinstance(src_file, bytes):
+			with open(cached_temp, 'wb') as w:
+				w.write(src_file)
+		else:
+			shutil.copy2(src_file, cached_temp)
+		os.replace(cached_temp, cached) #atomic, other workers never see a partial file
+	except OSError:
+		pass
+
+def cache_evict(cache_size):
+	#Delete the least recently used files until the cache is not bigger than cache_size bytes
+	if cache_dir is None or not os.path.isdir(cache_dir):
+		return
+	cached_files = []
+	for root, dirs, files in os.walk(cache_dir):
+		for name in files:
+			cached_stat = os.stat(os.path.join(root, name))
+			cached_files.append((cached_stat.st_atime, cached_stat.st_size, os.path.join(root, name)))
+	cached_total = sum(cached[1] for cached in cached_files)
+	for cached_atime, cached_size, cached in sorted(cached_files):
+		if cached_total <= cache_size:
+			break
+		os.remove(cached)
+		cached_total -= cached_size
+
+def thumbnail_open(image_path):
+	#Open the image at the lowest resolution that is still enough for the thumbnail:
+	# 1. the thumbnail embedded in the EXIF data (IFD1), if it's big enough and has the same aspect ratio (no black bars)
+	# 2. JPEG draft mode: the JPEG decoder scales the image by 1/2, 1/4 or 1/8 while decoding it
+	# 3. full decoding for the other formats
+	#Returns the image, the thumbnail box and the EXIF orientation of the source image
+	from PIL import Image, ExifTags
+	im = Image.open(image_path)
+	try:
+		exif        = im.getexif()
+		orientation = exif.get(0x0112) #Orientation
+	except:
+		exif        = None
+		orientation = None
+	if orientation in (6, 8): #the image will be rotated by 90°, so the thumbnail box is rotated as well
+		box = (thumbs_size[1], thumbs_size[0])
+	else:
+		box = thumbs_size
+	scale  = min(box[0] / im.width, box[1] / im.height, 1)
+	needed = (max(1, int(im.width * scale)), max(1, int(im.height * scale)))
+	if im.format == "JPEG":
+		try:
+			ifd1   = exif.get_ifd(ExifTags.IFD.IFD1)
+			offset = ifd1[0x0201] + 6 #JPEGInterchangeFormat, relative to the TIFF header that follows "Exif\0\0"
+			length = ifd1[0x0202]     #JPEGInterchangeFormatLength
+			im_ifd1 = Image.open(io.BytesIO(im.info["exif"][offset:offset+length]))
+			if im_ifd1.width >= needed[0] and im_ifd1.height >= needed[1] and abs(im_ifd1.width / im_ifd1.height - im.width / im.height) < 0.02 * im.width / im.height:
+				im_ifd1.load()
+				return im_ifd1, box, orientation
+		except:
+			pass
+		im.draft(im.mode, (needed[0] * 2, needed[1] * 2)) #decode at least at twice the thumbnail size to keep the resampling quality
+	return im, box, orientation
+
+def thumbnail_creation(thumb_job):
+	#THUMBNAIL CREATION: create a thumbnail image for a geotagged file. It runs in a worker process
+	#https://en.proft.me/2016/01/3/how-thumbnail-python-and-pillow/
+	#https://stackoverflow.com/questions/13872331/rotating-an-image-with-orientation-specified-in-exif-using-python-without-pil-in
+	#Returns the path of the thumbnail, or its content (bytes) if thumb_path is None (--kmz: the main process stores it in the .KMZ file)
+	image_path, thumb_path, cache_source = thumb_job
+	try:
+		cached = cache_file(cache_source, thumbs_params)
+		if thumb_path is None:
+			thumb_data = cache_read(cached)
+			if thumb_data is not None:
+				return thumb_data
+		elif cache_get(cached, thumb_path):
+			return thumb_path
+		im, box, orientation = thumbnail_open(image_path)
+		im.thumbnail(box)
+		#EXIF TAG ORIENTATION VALUES: 1=0°,8=90°,3=180°,6=270°
+		#https://www.daveperrett.com/articles/2012/07/28/exif-orientation-handling-is-a-ghetto/
+		#the image is rotated after being reduced: rotating a thumbnail is much cheaper than rotating the full image
+		if orientation == 8:
+			im = im.rotate(90, expand=True)
+		if orientation == 3:
+			im = im.rotate(180, expand=True)
+		if orientation == 6:
+			im = im.rotate(270, expand=True)
+		if thumb_path is None:
+			thumb_data = io.BytesIO()
+			im.save(thumb_data, 'JPEG', quality=80)
+			cache_put(thumb_data.getvalue(), cached)
+			return thumb_data.getvalue()
+		im.save(thumb_path, 'JPEG', quality=80)
+		cache_put(thumb_path, cached)
+	except:
+		thumb_path = pink_blank
+	return thumb_path
+
+def day_clusters(waypoints):
+	#Group the waypoints of a date taken within args.cluster meters from the first waypoint of a cluster (its representative)
+	#and within args.cluster_time minutes from the previous waypoint of the cluster.
+	#Returns {row of the representative: [other waypoints of the cluster]}, only for the clusters with more than one waypoint.
+	#The clusters are indexed in a grid of cells as big as the radius, so a waypoint is only compared with the clusters of the
+	#9 cells around it. The waypoints are sorted by Timestamp: the clusters closed by the time window are dropped from the grid
+	cluster_time = args.cluster_time * 60
+	cluster_grid = {}
+	clusters     = {}
+	for wp in waypoints:
+		y    = math.radians(wp.lat) * earth_radius
+		x    = math.radians(wp.long) * earth_radius * math.cos(math.radians(wp.lat))
+		cell = (int(x // args.cluster), int(y // args.cluster))
+		if wp.dt is None:
+			continue #a waypoint without a valid Timestamp is never clustered
+		wp_cluster = None
+		for near_cell in itertools.product((cell[0] - 1, cell[0], cell[0] + 1), (cell[1] - 1, cell[1], cell[1] + 1)):
+			near_clusters = cluster_grid.get(near_cell)
+			if not near_clusters:
+				continue
+			near_clusters[:] = [cluster for cluster in near_clusters if (wp.dt - cluster[3]).total_seconds() <= cluster_time]
+			for cluster in near_clusters:
+				if wp_cluster is None and math.hypot(x - cluster[1], y - cluster[2]) <= args.cluster:
+					wp_cluster = cluster
+		if wp_cluster is None:
+			cluster_grid.setdefault(cell, []).append([wp.row, x, y, wp.dt]) #representative, coordinates in meters, Timestamp of the last waypoint
+		else:
+			wp_cluster[3] = wp.dt
+			clusters.setdefault(wp_cluster[0], []).append(wp)
+	return clusters
+
+def cluster_index():
+	#Rows of the waypoints that are not the representative of their cluster (--cluster): they have no placemark and no thumbnail
+	clustered = set()
+	if args.cluster is not None:
+		for date, date_rows in exif_days():
+			for members in day_clusters(date_rows).values():
+				clustered.update(member.row for member in members)
+	return clustered
+
+def thumbnail_jobs(waypoints=None):
+	#Only the representative waypoint of a cluster (--cluster) has a thumbnail
+	for wp in (exif_rows() if waypoints is None else waypoints):
+		if wp.row in clustered_rows:
+			continue
+		if wp.fn.lower().endswith(".heic"):
+			image_path = prefix_heic + "/" + heic_name(wp.fn, wp.row) #SrcImgIfHEIC
+		else:
+			image_path = wp.dir + "/" + wp.fn #SrcImgIfNotHEIC
+		thumb_path = "%s/%s.jpg" % (prefix_thumbs,thumbs_name(wp.fn, wp.row))
+		#the thumbnail of a .heic file is cached using the original file as key, the .jpg file is new at every run
+		yield wp.row, thumb_path, (image_path, None if "thumbs" in kmz_files else thumb_path, wp.dir + "/" + wp.fn)
+
+def thumbnails_creation(waypoints=None):
+	#Create all the thumbnails before writing the .KML files, using a pool of "args.jobs" processes.
+	#The rows are processed in chunks to keep the memory bounded. Returns the rows whose thumbnail couldn't be created.
+	#With --kmz the thumbnails are stored in the .KMZ file as soon as they are returned by the workers, no folder is created.
+	#waypoints: only these waypoints (default: all the rows of the CSV)
+	thumbs_failed = set()
+	thumb_jobs    = thumbnail_jobs(waypoints)
+	if worker_pool is not None:
+		executor = worker_pool
+	else:
+		executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=cache_init, initargs=(cache_dir, cache_hash)) if args.jobs > 1 else None
+	try:
+		for thumb_chunk in iter(lambda: list(itertools.islice(thumb_jobs, 4096)), []):
+			thumb_rows = [(counter_row, thumb_path) for counter_row, thumb_path, thumb_job in thumb_chunk]
+			thumb_args = [thumb_job for counter_row, thumb_path, thumb_job in thumb_chunk]
+			if executor is not None:
+				thumb_results = executor.map(thumbnail_creation, thumb_args, chunksize=32)
+			else:
+				thumb_results = map(thumbnail_creation, thumb_args)
+			for (counter_row, thumb_path), thumb_result in zip(thumb_rows, thumb_results):
+				if thumb_result == pink_blank:
+					thumbs_failed.add(counter_row)
+				elif isinstance(thumb_result, bytes):
+					kmz_add(kmz_files["thumbs"], thumb_path, thumb_result)
+	finally:
+		if executor is not None and executor is not worker_pool:
+			executor.shutdown() #also if a thumbnail or the .KMZ file fails
+	return thumbs_failed
+
+def kmz_add(kmz_file, arcname, data):
+	#Store a .jpg file in a .KMZ file. JPEG data are already compressed, so they are stored without compression
+	kmz_file.writestr(zipfile.ZipInfo(arcname, time.localtime()[:6]), data, compress_type=zipfile.ZIP_STORED)
+
+def kmz_add_folder(folder):
+	#Move the .jpg files of a folder (e.g. the .heic conversions) to all the .KMZ files, then delete the folder
+	if not os.path.isdir(folder):
+		return
+	for name in sorted(os.listdir(folder)):
+		with open(os.path.join(folder, name), 'rb') as r:
+			data = r.read()
+		for kmz_file in kmz_files.values():
+			kmz_add(kmz_file, folder + "/" + name, data)
+	shutil.rmtree(folder)
 
-def os_check(exift_run):
-	if my_os != "Windows":
-		exift_run = exift_run.replace('"',"'")
-	return exift_run
+def kml_open(kml_type, tile_path=None):
+	#Open a .KML file for writing: the main .KML file, or a tile of the regionated .KML files (tile_path, relative to the given path).
+	#With --kmz it's an entry of the .KMZ file, compressed while it's written. Google Earth opens the first .kml file of the archive:
+	#doc.kml is added after the thumbnails (.jpg) but before the tiles
+	if kml_type in kmz_files:
+		return io.TextIOWrapper(io.BufferedWriter(kmz_files[kml_type].open(tile_path or "doc.kml", 'w', force_zip64=True), kml_buffer), encoding="utf-8")
+	if tile_path is None:
+		return open(file_GoogleEarth + kml_type + ".kml",'w',buffering=kml_buffer)
+	os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+	return open(tile_path,'w',buffering=kml_buffer)
 
-def kml_creation(kml_type):
+def kml_write(kml_files, fragment):
+	#Write a fragment shared by all the .KML files
+	for w in kml_files.values():
+		w.write(fragment)
+
+def path_colors():
+	#Yield the colors of the paths: the colors of the legend first, then random bright colors
 	# color legend - from left to right: ABGR color space
 	red         = "ff0000ff" 
 	yellow      = "ff00ffff"
@@ -137,12 +1252,25 @@ def kml_creation(kml_type):
 	mustard     = "ff00aaaa"
 	lightblue   = "ffffaa55" #From left to right: (A)lpha=ff,(B)lue=ff,(G)reen=aa,(R)ed=55
 	line_colors = [red, yellow, violet, green, pink, brownish, white, darkblue, mustard, lightblue]
+	for line_color in line_colors:
+		yield line_color
+	import randomcolor
+	while True:
+		rand_color = randomcolor.RandomColor()
+		rand_color = rand_color.generate(luminosity="bright") #output example (RGB): "#6b1ac9" (without quotes)
+		rgb_R = rand_color[0][1:3]
+		rgb_G = rand_color[0][3:5]
+		rgb_B = rand_color[0][5:]
+		rgb_A = "ff" #Alpha channel (255 = full opaque)
+		#https://en.wikipedia.org/wiki/RGBA_color_space
+		yield rgb_A + rgb_B + rgb_G + rgb_R
 
-	#KML HEADER
-	kml_start = """<?xml version="1.0" encoding="UTF-8"?>
+def kml_header(name):
+	#KML HEADER: document name and the styles used by the placemarks
+	return """<?xml version="1.0" encoding="UTF-8"?>
 	<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
 	<Document>
-		<name>Summary: %d waypoint(s), %d date(s), %d device(s)</name>
+		<name>%s</name>
 		<open>1</open>
 		<Style id="sh_pink-blank">
 			<IconStyle>
@@ -258,93 +1386,24 @@ def kml_creation(kml_type):
 			<ListStyle>
 			</ListStyle>
 		</Style>
-	""" % (numlines,len(uniq_dates),len(uniq_models))
+	""" % name
 
-	# KML FILE CREATION
-	w = open(file_GoogleEarth + kml_type + ".kml",'w')
-	w.write(kml_start)
+def popup_src(wp, href_prefix=""):
+	#Image shown in the popup of a waypoint
+	if wp.fn.lower().endswith(".heic"):
+		#if .heic then point to the .jpg converted file
+		return href_prefix + prefix_heic + "/" + heic_name(wp.fn, wp.row)
+	elif os.path.isabs(wp.dir):
+		return "%s/%s" % (wp.dir,wp.fn)
+	else:
+		return "%s%s/%s" % (href_prefix,wp.dir,wp.fn)
 
-	# GPSAltitudeRef
-	# 0 = Above Sea Level
-	# 1 = Below Sea Level
-	# https://exiftool.org/faq.html#Q6
+#PLACEMARK TEMPLATES of kml_placemarks
+#Only the template needed by each placemark is formatted, every placemark is written with one write() per .KML file
+pm_d_ThumbSize = 240 #preview image size
 
-	#PLACEMARK PREPARATION
-	counter_wp_date = 0
-	for yyyy in uniq_yyyy:
-		w.write("\t<Folder>\n")
-		w.write("\t\t\t<name>%s</name>\n" % yyyy) #Waypoints grouped by year (yyyy)
-		for yyyy_mm in uniq_yyyy_mm:
-			if yyyy_mm[:4] == yyyy:
-				w.write("\t\t\t<Folder>\n")
-				w.write("\t\t\t\t<name>%s</name>\n" % yyyy_mm) #Waypoints grouped by year-month (yyyy:mm)
-				for date in uniq_dates:
-					if date[:7] == yyyy_mm:
-						w.write("\t\t\t\t<Folder>\n")
-						w.write("\t\t\t\t\t<name>%s</name>\n" % date) #Waypoints grouped by year-month-day (yyyy:mm:dd)
-						counter_wp_date    += 1   #counter_wp_date increases every time date in uniq_dates changes
-						counter_1stwp_date  = 0
-						counter_row         = 0
-						coordinates_longlat = ""
-						coordinates_latlong = []
-						bing_path           = ""
-						w.write("\t\t\t\t\t<open>%d</open>\n" % counter_wp_date)
-						
-						for row in open(file_exif):
-							counter_row += 1
-							
-							#fields in the csv file
-							column   = row.split("\t")
-							c_ts     = column[0]
-							c_fn     = column[1]
-							c_dir    = column[2]
-							c_lat    = column[3]
-							c_long   = column[4]
-							c_alt    = column[5]
-							c_make   = column[6]
-							c_model  = column[7]
-							c_orient = column[8]
-							c_imgw   = column[9]
-							c_imgh   = column[10]
-							
-							if date in row:
-								counter_1stwp_date += 1
-								
-								if kml_type == "thumbs":
-									#THUMBNAIL CREATION: create a thumbnail image for each geotagged file
-									#https://en.proft.me/2016/01/3/how-thumbnail-python-and-pillow/
-									#https://stackoverflow.com/questions/13872331/rotating-an-image-with-orientation-specified-in-exif-using-python-without-pil-in
-									thumbs_styleid = c_fn[:c_fn.find(".")].lower() + "_" + str(counter_row) #styleid name for thumbnails
-									SIZE = (100, 150)
-									try:
-										if c_fn.lower().endswith(".heic"):
-											image_path = prefix_heic + "/" + c_fn[:c_fn.find(".")].lower() + "_heic_" + str(counter_row) + ".jpg" #SrcImgIfHEIC
-										else:
-											image_path = c_dir + "/" + c_fn #SrcImgIfNotHEIC
-										im = Image.open(image_path)
-										#EXIF TAG ORIENTATION VALUES: 1=0°,8=90°,3=180°,6=270°
-										#https://www.daveperrett.com/articles/2012/07/28/exif-orientation-handling-is-a-ghetto/
-										try:
-											for orientation in ExifTags.TAGS.keys():
-												if ExifTags.TAGS[orientation]=='Orientation':
-													break
-											exif = dict(im._getexif().items())
-											if exif[orientation] == 8:
-												im = im.rotate(90, expand=True)
-											if exif[orientation] == 3:
-												im = im.rotate(180, expand=True)
-											if exif[orientation] == 6:
-												im = im.rotate(270, expand=True)
-										except:
-											pass
-										im.thumbnail(SIZE)
-										thumb_path = "%s/%s.jpg" % (prefix_thumbs,thumbs_styleid)
-										im.save(thumb_path, 'JPEG', quality=80)
-									except:
-										thumb_path = "https://maps.google.com/mapfiles/kml/paddle/pink-blank.png"
-									
-									#STYLE FOR THUMBNAILS USED AS PLACEMARK ICONS
-									thumbs_style   = '''					<Style id="sh_%s">
+#STYLE FOR THUMBNAILS USED AS PLACEMARK ICONS
+thumbs_style = '''					<Style id="sh_%s">
 							<IconStyle>
 								<scale>1.3</scale>
 								<Icon>
@@ -384,103 +1443,106 @@ def kml_creation(kml_type):
 								<styleUrl>#sh_%s</styleUrl>
 							</Pair>
 						</StyleMap>
-									''' % (thumbs_styleid,thumb_path,thumbs_styleid,thumb_path,thumbs_styleid,thumbs_styleid,thumbs_styleid)
-									w.write(thumbs_style)
-								
-								w.write("\t\t\t\t\t<Placemark>\n")
-								w.write("\t\t\t\t\t\t<name>%s | %s %s | %s</name>\n" % (c_ts, c_make, c_model, c_fn))
-								
-								#PLACEMARK POPUP
-								pm_d_ThumbSize = 240 #preview image size
-								if c_fn.lower().endswith(".heic"):
-									#if .heic then point to the .jpg converted file
-									img_src = prefix_heic + "/" + c_fn[:c_fn.find(".")].lower() + "_heic_" + str(counter_row) + ".jpg"
-								else:
-									img_src = "%s/%s" % (c_dir,c_fn)
-								
-								#description for images with no rotation
-								pm_d_std = "\t\t\t\t\t\t<description><![CDATA[<table><tr><td><b>Timestamp</b><td> %s<tr><td><b>Google Maps</b><td> <a href='https://www.google.com/maps/place/%s,%s'>%s,%s</a><tr><td><b>Altitude </b><td> %s<tr><td><b>Device</b><br><br><td> %s %s<br><br><tr><td><b>Path</b><td> %s<tr><td><b>Filename</b><td> %s</table><table><tr><td>" % (c_ts, c_lat, c_long, c_lat, c_long, c_alt, c_make, c_model, c_dir, c_fn)
-								
-								#description for images with 90CW rotation
-								pm_d_90cw = "\t\t\t\t\t\t<description><![CDATA[<table><td><table><tr><td><b>Timestamp</b><td>%s<tr><td><b>Google Maps</b><td> <a href='https://www.google.com/maps/place/%s,%s'>%s,%s</a> <tr><td><b>Altitude</b><td>%s<tr><td><b>Device</b><br><br><td>%s %s<br><br><tr><td><b>Path</b><td> %s<tr><td><b>Filename</b><td>%s</table><td><table><tr><td><img src='%s' style='-webkit-transform:rotate(90deg);position: relative;top:30;width:%d;'></td></tr></table></table>]]></description>\n" % (c_ts,c_lat,c_long,c_lat,c_long,c_alt,c_make,c_model,c_dir,c_fn,img_src,pm_d_ThumbSize)
-								
-								#description for images without 90CW rotation but with height greater than width
-								pm_d_90 = "\t\t\t\t\t\t<description><![CDATA[<table><td><table><tr><td><b>Timestamp</b><td>%s<tr><td><b>Google Maps</b><td> <a href='https://www.google.com/maps/place/%s,%s'>%s,%s</a> <tr><td><b>Altitude</b><td>%s<tr><td><b>Device</b><br><br><td>%s %s<br><br><tr><td><b>Path</b><td> %s<tr><td><b>Filename</b><td>%s</table><td><table><tr><td><img src='%s' height='%d'></td></tr></table></table>]]></description>\n" % (c_ts,c_lat,c_long,c_lat,c_long,c_alt,c_make,c_model,c_dir,c_fn,img_src,pm_d_ThumbSize)
-
-								#.mov files need application/x-mplayer2
-								if c_fn.lower().endswith(".mov"):
-									w.write(pm_d_std)
-									w.write("<embed type='application/x-mplayer2' src='%s' name='MediaPlayer' height='%d' ShowControls='1' ShowStatusBar='1' ShowDisplay='1' autostart='0'></embed></td></tr></table>]]></description>\n" % (img_src,pm_d_ThumbSize))
-								else:
-									if "90 CW" in c_orient:
-										w.write(pm_d_90cw)
-									else:
-										if c_imgh > c_imgw:
-											w.write(pm_d_90)
-										else:
-											w.write(pm_d_std)
-											w.write("<img src='%s' height='%d'></td></tr></table>]]></description>\n" % (img_src,pm_d_ThumbSize))
-								if counter_1stwp_date == 1:    # this is the 1st waypoint of a new path. Set the icon "msn_man".
-									w.write("\t\t\t\t\t\t<styleUrl>#msn_man</styleUrl>\n\t\t\t\t\t\t<Point><coordinates>%s,%s</coordinates></Point>" % (c_long,c_lat))
-								else:
-									if kml_type == "thumbs":
-										w.write("\t\t\t\t\t\t\t<styleUrl>#msn_%s</styleUrl>\n\t\t\t\t\t\t\t<Point><coordinates>%s,%s</coordinates></Point>" % (thumbs_styleid,c_long,c_lat))
-									else:
-										w.write("\t\t\t\t\t\t<styleUrl>#msn_pink-blank</styleUrl>\n\t\t\t\t\t\t<Point><coordinates>%s,%s</coordinates></Point>" % (c_long,c_lat))
-								w.write("\n\t\t\t\t\t</Placemark>\n")
-								
-								#MEASURE DISTANCE BETWEEN POINTS
-								#Google Earth requires: longitude,latitude,altitude
-								coordinates_longlat = coordinates_longlat + str(c_long) + "," + str(c_lat) + ",0\t" # ",0" means no altitude defined
-								
-								#geopy requires: latitude,longitude
-								coordinates_latlong.append("(" + str(c_lat) + "," + str(c_long) + ")")
-								
-								#Bing (lat,long)
-								#https://docs.microsoft.com/en-us/bingmaps/articles/create-a-custom-map-url
-								bing_path = bing_path + "pos." + str(c_lat) + "_" + str(c_long) + "~"
-								
-								point_i   = 0
-								distance1 = 0
-								distance2 = 0
-								for point in coordinates_latlong:
-									point = point.replace("(","").replace(")","")
-									point = tuple(point.split(","))
-									point_i += 1
-									if point_i < len(coordinates_latlong):
-										point1 = point
-										point2 = (coordinates_latlong[point_i]).replace("(","").replace(")","")
-										point2 = tuple(point2.split(","))
-										distance1 = distance1 + geodesic(point1,point2).meters #change from "meters" to "feet" if needed
-										distance2 = distance2 + geodesic(point1,point2).km     #change from "km" to "miles" if needed
-								distance1 = round(distance1,2)
-								distance2 = round(distance2,2)
-								if distance2 < 1:
-									distance = str(distance1) + " m"  #change to "ft" if needed
-								else:
-									distance = str(distance2) + " km" #change to "mi" if needed
-						
-						#create path lines for dates containing more than one point
-						if counter_1stwp_date > 1:
-							try:
-								line_color = line_colors.pop(0)
-							except:
-								if kml_type == "icons":
-									rand_color = randomcolor.RandomColor()
-									rand_color = rand_color.generate(luminosity="bright") #output example (RGB): "#6b1ac9" (without quotes)
-									rgb_R = rand_color[0][1:3]
-									rgb_G = rand_color[0][3:5]
-									rgb_B = rand_color[0][5:]
-									rgb_A = "ff" #Alpha channel (255 = full opaque)
-									#https://en.wikipedia.org/wiki/RGBA_color_space
-									line_color = rgb_A + rgb_B + rgb_G + rgb_R
-									line_colors_random.append(line_color)
-								else:
-									line_color = line_colors_random.pop(0)
-									
-							#write path line
-							#Bing url - &mode=W means mode of transportation = Walking
-							w.write('''					<Placemark>
+									'''
+
+pm_name = "\t\t\t\t\t<Placemark>\n\t\t\t\t\t\t<name>%s | %s %s | %s</name>\n"
+
+#description for images with no rotation
+pm_d_std = "\t\t\t\t\t\t<description><![CDATA[<table><tr><td><b>Timestamp</b><td> %s<tr><td><b>Google Maps</b><td> <a href='https://www.google.com/maps/place/%s,%s'>%s,%s</a><tr><td><b>Altitude </b><td> %s<tr><td><b>Device</b><br><br><td> %s %s<br><br><tr><td><b>Path</b><td> %s<tr><td><b>Filename</b><td> %s</table><table><tr><td>"
+pm_d_img = pm_d_std + "<img src='%s' height='%d'></td></tr></table>]]></description>\n"
+
+#.mov files need application/x-mplayer2
+pm_d_mov = pm_d_std + "<embed type='application/x-mplayer2' src='%s' name='MediaPlayer' height='%d' ShowControls='1' ShowStatusBar='1' ShowDisplay='1' autostart='0'></embed></td></tr></table>]]></description>\n"
+
+#description for images with 90CW rotation
+pm_d_90cw = "\t\t\t\t\t\t<description><![CDATA[<table><td><table><tr><td><b>Timestamp</b><td>%s<tr><td><b>Google Maps</b><td> <a href='https://www.google.com/maps/place/%s,%s'>%s,%s</a> <tr><td><b>Altitude</b><td>%s<tr><td><b>Device</b><br><br><td>%s %s<br><br><tr><td><b>Path</b><td> %s<tr><td><b>Filename</b><td>%s</table><td><table><tr><td><img src='%s' style='-webkit-transform:rotate(90deg);position: relative;top:30;width:%d;'></td></tr></table></table>]]></description>\n"
+
+#description for images without 90CW rotation but with height greater than width
+pm_d_90 = "\t\t\t\t\t\t<description><![CDATA[<table><td><table><tr><td><b>Timestamp</b><td>%s<tr><td><b>Google Maps</b><td> <a href='https://www.google.com/maps/place/%s,%s'>%s,%s</a> <tr><td><b>Altitude</b><td>%s<tr><td><b>Device</b><br><br><td>%s %s<br><br><tr><td><b>Path</b><td> %s<tr><td><b>Filename</b><td>%s</table><td><table><tr><td><img src='%s' height='%d'></td></tr></table></table>]]></description>\n"
+
+pm_point_man   = "\t\t\t\t\t\t<styleUrl>#msn_man</styleUrl>\n\t\t\t\t\t\t<Point><coordinates>%s,%s</coordinates></Point>\n\t\t\t\t\t</Placemark>\n"
+pm_point_pink  = "\t\t\t\t\t\t<styleUrl>#msn_pink-blank</styleUrl>\n\t\t\t\t\t\t<Point><coordinates>%s,%s</coordinates></Point>\n\t\t\t\t\t</Placemark>\n"
+pm_point_thumb = "\t\t\t\t\t\t\t<styleUrl>#msn_%s</styleUrl>\n\t\t\t\t\t\t\t<Point><coordinates>%s,%s</coordinates></Point>\n\t\t\t\t\t</Placemark>\n"
+
+def kml_placemarks(wp, path_start, kml_types, href_prefix="", members=None):
+	#Placemark of a waypoint for each kml_type. The fragments shared by all the files are created once, only the placemark styles differ.
+	#path_start: first waypoint of a date. href_prefix: prefix of the relative paths of thumbnails and previews (e.g. "../" for the tiles of --regionate).
+	#members: the other waypoints of the cluster represented by wp (--cluster), listed in the popup
+	# GPSAltitudeRef
+	# 0 = Above Sea Level
+	# 1 = Below Sea Level
+	# https://exiftool.org/faq.html#Q6
+
+	#fields in the csv file, parsed by waypoint_parse()
+	counter_row = wp.row
+	c_ts     = wp.ts
+	c_fn     = wp.fn
+	c_dir    = wp.dir
+	c_lat    = wp.lat
+	c_long   = wp.long
+	c_alt    = wp.alt_text
+	c_make   = wp.make
+	c_model  = wp.model
+	c_orient = wp.orient
+
+	#PLACEMARK POPUP
+	img_src = popup_src(wp, href_prefix)
+
+	if c_fn.lower().endswith(".mov"):
+		pm_d = pm_d_mov
+	elif "90 CW" in c_orient:
+		pm_d = pm_d_90cw
+	elif wp.imgh is not None and wp.imgw is not None and wp.imgh > wp.imgw:
+		pm_d = pm_d_90
+	else:
+		pm_d = pm_d_img
+	if members:
+		pm_members = "<table><tr><td><b>Cluster</b><td> %d file(s) within %g m and %g min</table><table>" % (len(members) + 1, args.cluster, args.cluster_time)
+		pm_members += "".join("<tr><td>%s<td><a href='%s'>%s</a>" % (member.ts, popup_src(member, href_prefix), member.fn) for member in members)
+		pm_d = pm_d.replace("]]></description>", pm_members.replace("%", "%%") + "</table>]]></description>")
+		placemark = pm_name % (c_ts, c_make, c_model, "%s (+%d)" % (c_fn, len(members)))
+	else:
+		placemark = pm_name % (c_ts, c_make, c_model, c_fn)
+	placemark += pm_d % (c_ts,c_lat,c_long,c_lat,c_long,c_alt,c_make,c_model,c_dir,c_fn,img_src,pm_d_ThumbSize)
+
+	if path_start:    # this is the 1st waypoint of a new path. Set the icon "msn_man".
+		point = pm_point_man % (c_long,c_lat)
+	else:
+		point = pm_point_pink % (c_long,c_lat)
+	placemarks = {}
+	for kml_type in kml_types:
+		if kml_type == "thumbs":
+			thumbs_styleid = thumbs_name(c_fn, counter_row) #styleid name for thumbnails
+			if counter_row in thumbs_failed:
+				thumb_path = pink_blank
+			else:
+				thumb_path = "%s%s/%s.jpg" % (href_prefix,prefix_thumbs,thumbs_styleid) #thumbnail created by thumbnails_creation()
+			thumbs_point = point if path_start else pm_point_thumb % (thumbs_styleid,c_long,c_lat)
+			placemarks[kml_type] = thumbs_style % (thumbs_styleid,thumb_path,thumbs_styleid,thumb_path,thumbs_styleid,thumbs_styleid,thumbs_styleid) + placemark + thumbs_point
+		else:
+			placemarks[kml_type] = placemark + point
+	return placemarks
+
+def kml_path(date, waypoints, counter_wp_date, line_color):
+	#Path line of the waypoints of a date
+	#MEASURE DISTANCE BETWEEN POINTS (always on all the waypoints, also when the line is simplified)
+	distance_started = time.perf_counter()
+	coordinates = waypoints_coordinates(waypoints) if args.distance == "haversine" or args.simplify is not None else None #built once for both
+	path_distances[date] = path_distance(waypoints, coordinates)
+	distance = distance_format(path_distances[date])
+	distance_stats[0] += len(waypoints)
+	distance_stats[1] += time.perf_counter() - distance_started
+	if args.simplify is not None:
+		simplify_stats[0] += len(waypoints)
+		waypoints = [waypoints[i] for i in path_simplify(*coordinates, args.simplify)]
+		simplify_stats[1] += len(waypoints)
+	#Google Earth requires: longitude,latitude,altitude
+	coordinates_longlat = ["%s,%s,0\t" % (wp.long,wp.lat) for wp in waypoints] # ",0" means no altitude defined
+	#Bing (lat,long)
+	#https://docs.microsoft.com/en-us/bingmaps/articles/create-a-custom-map-url
+	bing_path = ["pos.%s_%s~" % (wp.lat,wp.long) for wp in waypoints]
+	#Bing url - &mode=W means mode of transportation = Walking
+	return ('''					<Placemark>
 							<name>Path %s</name>
 							<description><b>Distance traveled:</b><br>%s</br><![CDATA[<table><tr><td><br><b>Path:</b> view on <a href="javascript:window.open('about:blank');" onclick="window.open('https://bing.com/maps/default.aspx?rtp=%s&mode=W');">Bing</a><br><i>(Tested up to 80 waypoints)</i></table>]]></description>
 							<Style>
@@ -492,194 +1554,1030 @@ def kml_creation(kml_type):
 							<MultiGeometry> 
 								<LineString>
 								<tessellate>%d</tessellate>
-								<coordinates>''' % (date,distance,bing_path,line_color,counter_wp_date))
-							w.write(coordinates_longlat)
-							w.write('''</coordinates>
+								<coordinates>''' % (date,distance,"".join(bing_path),line_color,counter_wp_date)
+		+ "".join(coordinates_longlat) + '''</coordinates>
 								</LineString>
 							</MultiGeometry> 
 						</Placemark>''')
-						w.write("\n\t\t\t\t</Folder>\n") #close yyyy:mm:dd
-				w.write("\t\t\t</Folder>\n") #close yyyy:mm
-		w.write("\t\t</Folder>\n") #close yyyy
+
+def kml_day(kml_files, date, date_rows, counter_wp_date, line_colors, href_prefix=""):
+	#Folder of a date: placemarks of its waypoints and path line. line_colors: colors of the paths, the next one is used if the date has a path
+	kml_write(kml_files, "\t\t\t\t<Folder>\n")
+	kml_write(kml_files, "\t\t\t\t\t<name>%s</name>\n" % date) #Waypoints grouped by year-month-day (yyyy:mm:dd)
+	kml_write(kml_files, "\t\t\t\t\t<open>%d</open>\n" % counter_wp_date)
+	clusters = day_clusters(date_rows) if args.cluster is not None else {}
+	for counter_1stwp_date, wp in enumerate(date_rows, 1):
+		if wp.row in clustered_rows:
+			continue #listed in the popup of the representative of its cluster
+		for kml_type, placemark in kml_placemarks(wp, counter_1stwp_date == 1, kml_files, href_prefix, clusters.get(wp.row)).items():
+			kml_files[kml_type].write(placemark)
+	#create path lines for dates containing more than one point
+	if len(date_rows) > 1:
+		kml_write(kml_files, kml_path(date, date_rows, counter_wp_date, next(line_colors)))
+	kml_write(kml_files, "\n\t\t\t\t</Folder>\n") #close yyyy:mm:dd
+
+def kml_creation(kml_types):
+	#All the .KML files (one for each kml_type: "icons", "thumbs") are created with a single sequential read of the sorted CSV
+	kml_files = {kml_type: kml_open(kml_type) for kml_type in kml_types}
+	kml_write(kml_files, kml_header("Summary: %d waypoint(s), %d date(s), %d device(s)" % (numlines,len(uniq_dates),len(uniq_models))))
+	line_colors = path_colors()
+
+	#PLACEMARK PREPARATION
+	counter_wp_date = 0
+	for yyyy, yyyy_days in itertools.groupby(exif_days(), key=lambda day: day[0][:4]):
+		kml_write(kml_files, "\t<Folder>\n")
+		kml_write(kml_files, "\t\t\t<name>%s</name>\n" % yyyy) #Waypoints grouped by year (yyyy)
+		for yyyy_mm, yyyy_mm_days in itertools.groupby(yyyy_days, key=lambda day: day[0][:7]):
+			kml_write(kml_files, "\t\t\t<Folder>\n")
+			kml_write(kml_files, "\t\t\t\t<name>%s</name>\n" % yyyy_mm) #Waypoints grouped by year-month (yyyy:mm)
+			for date, date_rows in yyyy_mm_days:
+				counter_wp_date += 1   #counter_wp_date increases every time date in uniq_dates changes
+				kml_day(kml_files, date, date_rows, counter_wp_date, line_colors)
+			kml_write(kml_files, "\t\t\t</Folder>\n") #close yyyy:mm
+		kml_write(kml_files, "\t\t</Folder>\n") #close yyyy
 
 	#KML FOOTER
 	kml_end = "</Document>\n</kml>"
-	w.write(kml_end)
-	w.close()
+	kml_write(kml_files, kml_end)
+	for w in kml_files.values():
+		w.close()
+
+def region_tiles(waypoints, region_size):
+	#Quadtree of the waypoints for the regionated .KML files. Returns the tiles in breadth-first order (the first one is the root):
+	#(tile_id, (north, south, east, west), waypoints of the tile, [(child_id, child box)]).
+	#Each tile keeps the first waypoint of each cell of a grid of at most region_size cells laid over its box, so that the
+	#zoomed-out tiles show waypoints spread over the whole area. The other waypoints are passed to the tiles of the four quadrants
+	pad   = 0.00001 #degrees, a box must have an area even if all its waypoints have the same coordinates
+	grid  = max(1, int(region_size ** 0.5))
+	box   = (max(wp.lat for wp in waypoints) + pad, min(wp.lat for wp in waypoints) - pad, max(wp.long for wp in waypoints) + pad, min(wp.long for wp in waypoints) - pad)
+	tiles     = []
+	pending = deque([(0, box, waypoints, 0)])
+	tile_next = 1
+	while pending:
+		tile_id, box, tile_waypoints, depth = pending.popleft()
+		north, south, east, west = box
+		if len(tile_waypoints) <= region_size or depth == region_depth:
+			tiles.append((tile_id, box, tile_waypoints, []))
+			continue
+		tile_kept  = []
+		tile_cells = set()
+		quadrants  = [[], [], [], []] #NW, NE, SW, SE
+		mid_lat    = (north + south) / 2
+		mid_long   = (east + west) / 2
+		for wp in tile_waypoints:
+			cell = (min(grid - 1, int((north - wp.lat) / (north - south) * grid)), min(grid - 1, int((wp.long - west) / (east - west) * grid)))
+			if cell not in tile_cells:
+				tile_cells.add(cell)
+				tile_kept.append(wp)
+			else:
+				quadrants[(wp.lat < mid_lat) * 2 + (wp.long >= mid_long)].append(wp)
+		quadrant_boxes = [(north, mid_lat, mid_long, west), (north, mid_lat, east, mid_long), (mid_lat, south, mid_long, west), (mid_lat, south, east, mid_long)]
+		tile_children  = []
+		for quadrant_waypoints, quadrant_box in zip(quadrants, quadrant_boxes):
+			if quadrant_waypoints:
+				tile_children.append((tile_next, quadrant_box))
+				pending.append((tile_next, quadrant_box, quadrant_waypoints, depth + 1))
+				tile_next += 1
+		tiles.append((tile_id, box, tile_kept, tile_children))
+	return tiles
 
+def kml_region(box, min_lod):
+	#Region: the features are shown (or the tile is loaded) when the box covers at least min_lod pixels on screen
+	#https://developers.google.com/kml/documentation/regions
+	return """		<Region>
+			<LatLonAltBox><north>%.6f</north><south>%.6f</south><east>%.6f</east><west>%.6f</west></LatLonAltBox>
+			<Lod><minLodPixels>%d</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod>
+		</Region>
+""" % (box + (min_lod,))
 
-#***************** BEGIN *****************
-welcome() 
+def kml_network_link(name, href, box=None, refresh=None):
+	#NetworkLink to a tile, loaded when its Region becomes active (no Region: always loaded).
+	#refresh: the linked file is loaded again every "refresh" seconds instead (the dates of --watch)
+	if refresh is None:
+		link_refresh = "<viewRefreshMode>onRegion</viewRefreshMode>"
+	else:
+		link_refresh = "<refreshMode>onInterval</refreshMode><refreshInterval>%g</refreshInterval>" % refresh
+	return """		<NetworkLink>
+			<name>%s</name>
+%s			<Link><href>%s</href>%s</Link>
+		</NetworkLink>
+""" % (name, kml_region(box, 128) if box is not None else "", href, link_refresh)
 
-start_time = datetime.now()
-ptime      = start_time.strftime('%Y%m%d_%H%M%S')
+def kml_regionated(kml_types):
+	#Regionated .KML files (--regionate) for cases with too many placemarks to be opened at once. The main .KML file contains the
+	#paths and a NetworkLink to the root tile of a quadtree (see region_tiles): Google Earth only loads the tiles that are big enough
+	#on screen, so the waypoints appear progressively while zooming in. Each waypoint is in exactly one tile.
+	#Unlike kml_creation(), the waypoints are kept in memory to build the quadtree
+	tiles_dir   = {kml_type: file_GoogleEarth + kml_type + "_tiles" for kml_type in kml_types}
+	waypoints   = []
+	path_starts = set()
+	clusters    = {}
+	kml_files   = {kml_type: kml_open(kml_type) for kml_type in kml_types}
+	kml_write(kml_files, kml_header("Summary: %d waypoint(s), %d date(s), %d device(s)" % (numlines,len(uniq_dates),len(uniq_models))))
+	line_colors = path_colors()
+	kml_write(kml_files, "\t<Folder>\n\t\t\t<name>Paths</name>\n")
+	for counter_wp_date, (date, date_rows) in enumerate(exif_days(), 1):
+		path_starts.add(date_rows[0].row)
+		if args.cluster is not None:
+			clusters.update(day_clusters(date_rows))
+		waypoints.extend(wp for wp in date_rows if wp.row not in clustered_rows)
+		if len(date_rows) > 1:
+			kml_write(kml_files, kml_path(date, date_rows, counter_wp_date, next(line_colors)))
+	kml_write(kml_files, "\n\t\t</Folder>\n")
+	tiles = region_tiles(waypoints, args.region_size)
+	for kml_type, w in kml_files.items():
+		w.write(kml_network_link("Waypoints", "%s/0.kml" % os.path.basename(tiles_dir[kml_type])))
+		w.write("</Document>\n</kml>")
+		w.close()
+	waypoints = None
 
-my_os            = platform.system() #Possible output: Windows: Windows, Linux: Linux, Mac: Darwin
-file_temp        = ptime + '_temp.csv'
-file_exif        = ptime + '_exif.csv'
-file_GoogleEarth = ptime + '_'
+	#TILES: placemarks of the tile and links to the tiles of its quadrants. The paths in the tiles are relative to the tiles folder
+	for tile_id, box, tile_waypoints, tile_children in tiles:
+		tile_files = {kml_type: kml_open(kml_type, "%s/%d.kml" % (tiles_dir[kml_type], tile_id)) for kml_type in kml_types}
+		kml_write(tile_files, kml_header("Tile %d: %d waypoint(s)" % (tile_id, len(tile_waypoints))))
+		kml_write(tile_files, kml_region(box, 0 if tile_id == 0 else 128))
+		for wp in tile_waypoints:
+			for kml_type, placemark in kml_placemarks(wp, wp.row in path_starts, tile_files, "../", clusters.get(wp.row)).items():
+				tile_files[kml_type].write(placemark)
+		for child_id, child_box in tile_children:
+			kml_write(tile_files, kml_network_link("Tile %d" % child_id, "%d.kml" % child_id, child_box))
+		kml_write(tile_files, "</Document>\n</kml>")
+		for w in tile_files.values():
+			w.close()
 
-prefix_thumbs = ptime + "_thumbs"
-prefix_heic   = ptime + "_heic"
 
-with open(file_temp, 'w') as w:
-	w.write("DateTimeOriginal\tCreateDate\tCreationDate\tModifyDate\tFilename\tDirectory\tGpsLatitude\tGpsLongitude\tGpsAltitude\tMake\tModel\tOrientation\tImageWidth\tImageHeight\n") #header row
-w.close()
+#***************** PIPELINE *****************
+#The steps of a run: run_init -> scan -> normalize -> build -> write -> run_end. Used by the command line and by run(), which a
+#long-lived process can call repeatedly. Like the rest of the script, the steps share the state of the run in module globals
 
 # EXIFTOOL: explanation of the options used by the script
 # (DateTimeOriginal is in LOCAL TIME)
 #
+# -stay_open True -@ -             Keep ExifTool running and read the arguments from stdin, one batch of files for each -execute
 # -q          (-quiet)             Quiet processing
-# -ext EXT    (-extension)         Process files with specified extension
+# -charset filename=utf8           The file names are UTF-8 encoded
 # -if EXPR                         Conditionally process files
 # defined                          if condition is True
 # ref tags:
 #          exif:gpslongitude
 #          exif:DateTimeOriginal
-# -r                               Recursive search
 # -gpslongitude# -gpslatitude#    Print coordinates in Decimal Degrees (by default, without #, output is Degrees Minutes Seconds)
 #
 # Metadata fields that will appear in the CSV output file:
 # -datetimeoriginal %s
 # -T          (-table)             Output in tabular format
 #
+#SEARCH GEOTAGGED FILES (tag names are not case sensitive)
+exift_tags = "-datetimeoriginal -CreateDate -CreationDate -ModifyDate -filename -directory -gpslatitude# -gpslongitude# -gpsaltitude -make -model -orientation -imagewidth -imageheight"
+kml_types  = ["icons", "thumbs"]
+
+def run_init(run_args):
+	#Start a run with the given options (see welcome and options): reset the state of the previous run, go to the path
+	#to analyze (the output files are saved there), open the cache and create the temporary CSV
+	global args, run_cwd, start_time, end_time, ptime, my_os, file_temp, file_exif, file_GoogleEarth, prefix_thumbs, prefix_heic, kmz_files
+	args    = run_args
+	run_cwd = os.getcwd()
+	os.chdir(args.path)
 
+	start_time = datetime.now()
+	end_time   = None
+	ptime      = start_time.strftime('%Y%m%d_%H%M%S')
 
-#********************** SEARCH GEOTAGGED FILES (tag names are not case sensitive) **********************
-exift_search = "exiftool -q -r *"
-exift_if     = '-if "defined $gpslongitude"'
-exift_tags   = "-datetimeoriginal -CreateDate -CreationDate -ModifyDate -filename -directory -gpslatitude# -gpslongitude# -gpsaltitude -make -model -orientation -imagewidth -imageheight"
-
-exift_run = '%s %s -T %s >> %s' % (exift_search, exift_if, exift_tags, file_temp)
-exift_run = os_check(exift_run)
-os.system(exift_run)
-
-#The number of lines in the file is the number of geotagged files found
-with open(file_temp, 'r') as r:
-    numlines = len(r.readlines())-1 #don't count the header row
-
-r.close()
-
-#Check timestamps
-temp = []
-if numlines > 0:
-	os.mkdir(prefix_thumbs)
-	csv_rows = csv.DictReader(open(file_temp), delimiter='\t')
-	for csv_row in csv_rows:
-		csv_tags = csv_row["Filename"] + "\t" + csv_row["Directory"] + "\t" + csv_row["GpsLatitude"] + "\t" + csv_row["GpsLongitude"] + "\t" + csv_row["GpsAltitude"] + "\t" + csv_row["Make"] + "\t" + csv_row["Model"] + "\t" + csv_row["Orientation"] + "\t" + csv_row["ImageWidth"] + "\t" + csv_row["ImageHeight"] + "\n"
-		if csv_row["Filename"].lower().endswith(".mov"):
-			csv_row = csv_row["CreationDate"] + csv_tags
-		else: #for all the other files (NOT .mov)
-			if len(csv_row["DateTimeOriginal"]) == 1: #if DateTimeOriginal is missing
-				if len(csv_row["CreateDate"]) > 1: #check if CreateDate exists
-					csv_row = csv_row["CreateDate"] + "\t" + csv_tags
-				if len(csv_row["CreateDate"]) == 1: #if CreateDate is missing
-					csv_row = csv_row["ModifyDate"] + "\t" + csv_tags
-			if len(csv_row["DateTimeOriginal"]) > 1: #if DateTimeOriginal exists
-				csv_row = csv_row["DateTimeOriginal"] + "\t" + csv_tags
-		temp.append(csv_row)
-
-	#Create a new CSV with rows sorted by Timestamp
+	my_os            = platform.system() #Possible output: Windows: Windows, Linux: Linux, Mac: Darwin
+	file_temp        = ptime + '_temp.csv'
+	file_exif        = ptime + '_exif.csv'
+	file_GoogleEarth = ptime + '_'
+
+	prefix_thumbs = ptime + "_thumbs"
+	prefix_heic   = ptime + "_heic"
+	kmz_files     = {}
+
+	if args.no_cache:
+		cache_init(None, False)
+	else:
+		cache_init(os.path.abspath(args.cache_dir), args.cache_hash)
+	run_reset()
+
+def run_reset():
+	#Reset the counters and the statistics and create the temporary CSV: at the beginning of a run and of each update of --watch
+	global numlines, uniq_dates_counter, uniq_models_counter, uniq_dates, uniq_models, index_scanned, index_removed, clustered_rows, clustered_count, thumbs_failed, partitions
+	numlines            = 0
+	uniq_dates_counter  = Counter()
+	uniq_models_counter = Counter() #used to count the number of files per device model
+	uniq_dates          = []
+	uniq_models         = []
+	index_scanned       = 0
+	index_removed       = 0
+	clustered_rows      = set()
+	clustered_count     = 0
+	thumbs_failed       = set()
+	partitions          = []
+	path_distances.clear()
+	exift_stats[:]      = []
+	fast_stats[:]       = [0, 0]
+	simplify_stats[:]   = [0, 0]
+	distance_stats[:]   = [0, 0]
+	stage_stats[:]      = []
+
+	with open(file_temp, 'w') as w:
+		w.write("\t".join(temp_columns) + "\n") #header row
+
+def scan():
+	#Extract the metadata of the geotagged files with ExifTool into the temporary CSV (see metadata_index).
+	#Returns the number of files scanned
+	global index_scanned, index_removed
+	stage_started = stage_start()
+	index_scanned, index_removed = metadata_index(file_temp, exift_tags)
+	stage_end("ExifTool scan", stage_started, index_scanned)
+	return index_scanned
+
+def normalize():
+	#Check timestamps, then create a new CSV with rows sorted by Timestamp.
+	#The number of rows is the number of geotagged files found. Unique dates and models will be used to name folders and in the summary
+	global numlines, uniq_dates, uniq_models
+	stage_started = stage_start()
 	with open(file_exif, 'w') as w:
-		w.write("Timestamp\tFilename\tDirectory\tGpsLatitude#\tGpsLongitude#\tGpsAltitude\tMake\tModel\tOrientation\tImageWidth\tImageHeight\n") #header row
-		for row in sorted(temp):
+		w.write(exif_header) #header row
+		for row in rows_sorted(temp_rows(file_temp), args.sort_buffer):
 			w.write(row)
+			column = row.split("\t")
+			numlines += 1
+			uniq_dates_counter[column[0][:10]] += 1              #Grab YYYY:MM:DD (first 10 characters)
+			uniq_models_counter[column[6] + " " + column[7]] += 1 #Make Model
+	uniq_dates  = sorted(uniq_dates_counter)
+	uniq_models = sorted(uniq_models_counter)
+	stage_end("Timestamps and sorting", stage_started, numlines)
+	if numlines == 0:
+		os.remove(file_exif)
+	return numlines
 
-	w.close()
-
-	#convert heic to jpg
-	counter_row = 0
-	for row in open(file_exif):
-		counter_row += 1
-		column   = row.split("\t")
-		c_ts     = column[0]
-		c_fn     = column[1]
-		c_dir    = column[2]
-		c_lat    = column[3]
-		c_long   = column[4]
-		c_alt    = column[5]
-		c_make   = column[6]
-		c_model  = column[7]
-		c_orient = column[8]
-		c_imgw   = column[9]
-		c_imgh   = column[10]
-		if c_fn.lower().endswith(".heic"):
-			try:
-				os.mkdir(prefix_heic)
-			except:
-				pass
-			#https://forensenellanebbia.blogspot.com/2018/09/converting-from-heic-to-jpg.html
-			dstfile = c_fn[:c_fn.find(".")].lower() + "_heic_" + str(counter_row) + ".jpg"
-			if my_os == "Linux":
-				heif_linux = "heif-convert %s/%s %s/%s > /dev/null" % (c_dir,c_fn,prefix_heic,dstfile)
-				os.system(heif_linux)
+def build():
+	#Convert the .heic files, cluster the waypoints and create the thumbnails used by the .KML files
+	global clustered_rows, clustered_count, thumbs_failed, kmz_files
+	if numlines == 0:
+		return
+	if args.partition:
+		partitions_creation() #each partition is built by a worker process, .KML files included
+		return
+	if args.kmz:
+		#one .KMZ file for each .KML, doc.kml is compressed, the .jpg files are stored as they are
+		kmz_files = {kml_type: zipfile.ZipFile(file_GoogleEarth + kml_type + ".kmz", 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) for kml_type in kml_types}
+	else:
+		os.mkdir(prefix_thumbs)
+
+	stage_started = stage_start()
+	heic_count = heic_conversion() #convert heic to jpg
+	stage_end("HEIC conversion", stage_started, heic_count)
+
+	stage_started = stage_start()
+	clustered_rows  = cluster_index() #waypoints merged in the placemark of their cluster (--cluster)
+	clustered_count = len(clustered_rows)
+	if args.cluster is not None:
+		stage_end("Clustering", stage_started, numlines)
+
+	stage_started = stage_start()
+	thumbs_failed = thumbnails_creation() #create the thumbnails used by the "thumbs" .KML
+	stage_end("Thumbnails", stage_started, numlines - len(clustered_rows))
+
+def write():
+	#Create the .KML (or .KMZ) files and the exports of the waypoints (--export)
+	if numlines == 0:
+		return
+	if args.partition:
+		partitions_index() #main .KML files, linking the .KML files of the partitions
+	else:
+		stage_started = stage_start()
+		if args.profile:
+			import cProfile
+			kml_profile = cProfile.Profile()
+			kml_profile.enable()
+		if args.regionate:
+			kml_regionated(kml_types) #create the regionated .KML files: paths, and waypoints in tiles loaded on demand
+		else:
+			kml_creation(kml_types) #create .KML with standard icons and .KML with thumbnails
+
+		if args.kmz:
+			kmz_add_folder(prefix_heic) #the .heic conversions are also used by the popups of the "icons" .KML
+			for kmz_file in kmz_files.values():
+				kmz_file.close()
+		if args.profile:
+			kml_profile.disable()
+			kml_profile.dump_stats(file_GoogleEarth + "kml.prof") #python -m pstats <file>
+		stage_end("KML files", stage_started, numlines - len(clustered_rows))
+		stage_stats.append(("  of which distance math", distance_stats[1], None, distance_stats[0]))
+	if args.export:
+		stage_started = stage_start()
+		export_count  = waypoints_export()
+		stage_end("Export", stage_started, export_count)
+	if args.store:
+		stage_started = stage_start()
+		store_build()
+		stage_end("Store", stage_started, numlines)
+
+def waypoint_record(wp):
+	#Typed values of a waypoint exported by --export, None if missing ("-" in the CSV)
+	return {"row": wp.row, "timestamp": wp.dt, "timestamp_text": wp.ts, "date": wp.ts[:10], "filename": wp.fn, "directory": wp.dir,
+		"latitude": wp.lat, "longitude": wp.long, "altitude": wp.alt, "make": None if wp.make == "-" else wp.make,
+		"model": None if wp.model == "-" else wp.model, "device": wp.make + " " + wp.model, "orientation": None if wp.orient == "-" else wp.orient,
+		"image_width": wp.imgw, "image_height": wp.imgh}
+
+def path_record(date, waypoints, partition=None):
+	#Statistics of the path of a date (of a partition with --partition) exported by --export: waypoints, devices, first and last
+	#Timestamp, distance (the one of the .KML files if they measured it) and bounding box
+	timestamps = [wp.dt for wp in waypoints if wp.dt is not None]
+	distance   = path_distances.get(date if partition is None else (partition, date))
+	if distance is None:
+		distance = path_distance(waypoints) if len(waypoints) > 1 else 0.0
+	return {"date": date, "partition": partition, "waypoints": len(waypoints), "devices": len(set((wp.make, wp.model) for wp in waypoints)),
+		"first": timestamps[0] if timestamps else None, "last": timestamps[-1] if timestamps else None,
+		"duration_s": (timestamps[-1] - timestamps[0]).total_seconds() if timestamps else None, "distance_m": distance,
+		"north": max(wp.lat for wp in waypoints), "south": min(wp.lat for wp in waypoints),
+		"east": max(wp.long for wp in waypoints), "west": min(wp.long for wp in waypoints)}
+
+def export_schemas():
+	#Arrow schemas of the waypoints table and of the paths table (one row per date) of --export parquet/arrow
+	import pyarrow as pa
+	waypoints_schema = pa.schema([("row", pa.int64()), ("timestamp", pa.timestamp("ms")), ("timestamp_text", pa.string()), ("date", pa.string()),
+		("filename", pa.string()), ("directory", pa.string()), ("latitude", pa.float64()), ("longitude", pa.float64()), ("altitude", pa.float64()),
+		("make", pa.string()), ("model", pa.string()), ("device", pa.string()), ("orientation", pa.string()), ("image_width", pa.int32()), ("image_height", pa.int32())])
+	paths_schema = pa.schema([("date", pa.string()), ("partition", pa.string()), ("waypoints", pa.int64()), ("devices", pa.int32()), ("first", pa.timestamp("ms")), ("last", pa.timestamp("ms")),
+		("duration_s", pa.float64()), ("distance_m", pa.float64()), ("north", pa.float64()), ("south", pa.float64()), ("east", pa.float64()), ("west", pa.float64())])
+	return {"waypoints": waypoints_schema, "paths": paths_schema}
+
+def waypoints_export():
+	#--export: the waypoints of the CSV sorted by Timestamp with typed columns (see waypoint_record) and the statistics of the path
+	#of each date (see path_record), of each date of each partition with --partition, written while the CSV is read, one date at a time:
+	# - parquet: <timestamp>_waypoints.parquet and <timestamp>_paths.parquet, a row group every export_batch_size rows
+	# - arrow  : the same tables in Arrow IPC files (uncompressed, they can be memory-mapped)
+	# - geojson: <timestamp>_waypoints.geojsonl, a Point for each waypoint and a LineString for the path of each date
+	#Returns the number of waypoints exported
+	export_formats = set(args.export)
+	table_writers  = {"waypoints": [], "paths": []}
+	if export_formats & {"parquet", "arrow"}:
+		import pyarrow as pa
+		import pyarrow.parquet
+		schemas = export_schemas()
+		for table, schema in schemas.items():
+			if "parquet" in export_formats:
+				table_writers[table].append(pyarrow.parquet.ParquetWriter(file_GoogleEarth + table + ".parquet", schema))
+			if "arrow" in export_formats:
+				table_writers[table].append(pa.ipc.new_file(file_GoogleEarth + table + ".arrow", schema))
+	geojson = open(file_GoogleEarth + "waypoints.geojsonl", 'w', encoding="utf-8", buffering=kml_buffer) if "geojson" in export_formats else None
+	table_records = {"waypoints": [], "paths": []}
+	export_count  = 0
+	for date, date_rows in exif_days():
+		records = [waypoint_record(wp) for wp in date_rows]
+		if args.partition:
+			part_rows = {}
+			for wp in date_rows:
+				part_rows.setdefault(partition_label(wp.ts, wp.dir, wp.make, wp.model), []).append(wp)
+			paths = [(path_record(date, rows, label), rows) for label, rows in sorted(part_rows.items())]
+		else:
+			paths = [(path_record(date, date_rows), date_rows)]
+		export_count += len(records)
+		if geojson is not None:
+			for record in records:
+				geojson.write(json.dumps({"type": "Feature", "geometry": {"type": "Point", "coordinates": [record["longitude"], record["latitude"]]}, "properties": record},
+					default=datetime.isoformat, ensure_ascii=False, separators=(",", ":")) + "\n")
+			for path, rows in paths:
+				if len(rows) > 1:
+					geojson.write(json.dumps({"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[wp.long, wp.lat] for wp in rows]}, "properties": path},
+						default=datetime.isoformat, ensure_ascii=False, separators=(",", ":")) + "\n")
+		if table_writers["waypoints"]:
+			table_records["waypoints"].extend(records)
+			table_records["paths"].extend(path for path, rows in paths)
+			for table, records in table_records.items():
+				if len(records) >= export_batch_size:
+					export_flush(table_writers[table], schemas[table], records)
+	for table, records in table_records.items():
+		if records:
+			export_flush(table_writers[table], schemas[table], records)
+		for writer in table_writers[table]:
+			writer.close()
+	if geojson is not None:
+		geojson.close()
+	return export_count
+
+def export_flush(writers, schema, records):
+	#Write the pending records of a table as a record batch, then empty the list
+	import pyarrow as pa
+	batch = pa.RecordBatch.from_pylist(records, schema=schema)
+	for writer in writers:
+		writer.write_batch(batch)
+	records.clear()
+
+def store_seconds(dt):
+	#ts of a Timestamp in the store: seconds since 1970-01-01 (local time, like the EXIF timestamps)
+	if dt is None:
+		return store_nat
+	return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+def store_cells(lat, long, cell):
+	#Cell of the grid index of the store for each position: row (latitude) * columns + column (longitude)
+	import numpy as np
+	columns = int(round(360 / cell))
+	row     = np.floor((np.asarray(lat, dtype=np.float64) + 90) / cell).astype(np.int64)
+	column  = np.clip(np.floor((np.asarray(long, dtype=np.float64) + 180) / cell).astype(np.int64), 0, columns - 1)
+	return row * columns + column
+
+def store_build():
+	#--store: save the waypoints of the CSV sorted by Timestamp in store_dir for the query subcommand:
+	# - records.npy  : a fixed-width record for each waypoint (see store_record), memory-mapped by the queries. offset and length
+	#                  are the position of its row in rows.txt
+	# - rows.txt     : the rows of the CSV (UTF-8), parsed again only for the waypoints selected by a query
+	# - time_keys.npy, time_rows.npy                 : ts of the records in ascending order and their records (time index)
+	# - grid_cells.npy, grid_starts.npy, grid_rows.npy: the records of each cell of a grid of store_cell degrees (space index)
+	#The store is written in a temporary folder that replaces the previous one when it's complete
+	import numpy as np
+	store_temp = store_dir + ".tmp"
+	shutil.rmtree(store_temp, ignore_errors=True)
+	os.mkdir(store_temp)
+	records = np.lib.format.open_memmap(store_temp + "/records.npy", mode="w+", dtype=store_record, shape=(numlines,))
+	offset  = 0
+	with open(file_exif) as r, open(store_temp + "/rows.txt", 'wb') as w:
+		next(r) #skip the header row
+		rows = enumerate(r, 2)
+		for row_chunk in iter(lambda: list(itertools.islice(rows, export_batch_size)), []):
+			chunk_records = []
+			for counter_row, row in row_chunk:
+				wp   = waypoint_parse(counter_row, row)
+				data = row.encode("utf-8")
+				chunk_records.append((store_seconds(wp.dt), wp.lat, wp.long, offset, len(data)))
+				w.write(data)
+				offset += len(data)
+			records[row_chunk[0][0] - 2:row_chunk[-1][0] - 1] = chunk_records
+	time_rows = np.argsort(records["ts"], kind="stable")
+	np.save(store_temp + "/time_rows.npy", time_rows)
+	np.save(store_temp + "/time_keys.npy", records["ts"][time_rows])
+	grid_rows = np.argsort(store_cells(records["lat"], records["long"], store_cell), kind="stable")
+	grid_cells, grid_starts = np.unique(store_cells(records["lat"][grid_rows], records["long"][grid_rows], store_cell), return_index=True)
+	np.save(store_temp + "/grid_rows.npy", grid_rows)
+	np.save(store_temp + "/grid_cells.npy", grid_cells)
+	np.save(store_temp + "/grid_starts.npy", np.append(grid_starts, numlines))
+	records.flush()
+	del records
+	with open(store_temp + "/meta.json", 'w') as w:
+		json.dump({"version": version, "created": str(start_time), "waypoints": numlines, "cell": store_cell, "dates": len(uniq_dates), "devices": len(uniq_models)}, w, indent=1)
+	shutil.rmtree(store_dir, ignore_errors=True)
+	os.rename(store_temp, store_dir)
+
+def query_time(text, period_end=False):
+	#Timestamp of --from/--to: YYYY, YYYY-MM, YYYY-MM-DD, YYYY-MM-DD HH:MM or YYYY-MM-DD HH:MM:SS ("-", ":", " " and "T" are all
+	#accepted as separators). period_end: last second of the period (e.g. 2019-06 = 2019-06-30 23:59:59)
+	parts = [int(part) for part in text.replace("T", " ").replace("-", " ").replace(":", " ").split()]
+	if not 1 <= len(parts) <= 6:
+		raise ValueError("invalid time: %s" % text)
+	start = datetime(*(parts + [1, 1, 0, 0, 0][len(parts) - 1:]))
+	if not period_end:
+		return start
+	if len(parts) == 1:
+		end = start.replace(year=start.year + 1)
+	elif len(parts) == 2:
+		end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+	else:
+		end = start + timedelta(**{["days", "hours", "minutes", "seconds"][len(parts) - 3]: 1})
+	return end - timedelta(seconds=1)
+
+def radius_box(lat, long, meters):
+	#Bounding box (north, south, east, west) of a circle, east < west if it crosses the 180th meridian
+	dlat  = math.degrees(meters / earth_radius)
+	north = min(lat + dlat, 90)
+	south = max(lat - dlat, -90)
+	if north == 90 or south == -90 or math.cos(math.radians(lat)) < 1e-9:
+		return north, south, 180, -180
+	dlong = math.degrees(meters / (earth_radius * math.cos(math.radians(max(abs(north), abs(south))))))
+	if dlong >= 180:
+		return north, south, 180, -180
+	east = long + dlong if long + dlong <= 180 else long + dlong - 360
+	west = long - dlong if long - dlong >= -180 else long - dlong + 360
+	return north, south, east, west
+
+def store_query(time_from=None, time_to=None, bbox=None, radius=None):
+	#Records of the store (see store_build) in the time range [time_from, time_to] (datetime, None = unbounded) and in the bounding
+	#box (north, south, east, west) or in the circle (lat, long, meters), in Timestamp order.
+	#The index that selects fewer records (time index or the grid cells covering the box) gives the candidates, which are then
+	#checked against all the conditions. Only the index arrays and the records of the candidates are read from disk
+	import numpy as np
+	with open(store_dir + "/meta.json") as r:
+		store_meta = json.load(r)
+	records    = np.load(store_dir + "/records.npy", mmap_mode="r")
+	candidates = [(np.arange(len(records)), 0, len(records))]
+	if time_from is not None or time_to is not None:
+		time_keys  = np.load(store_dir + "/time_keys.npy", mmap_mode="r")
+		time_start = np.searchsorted(time_keys, store_nat if time_from is None else store_seconds(time_from), "right" if time_from is None else "left")
+		time_end   = len(time_keys) if time_to is None else np.searchsorted(time_keys, store_seconds(time_to), "right")
+		candidates = [(np.load(store_dir + "/time_rows.npy", mmap_mode="r"), time_start, max(time_start, time_end))]
+	if radius is not None:
+		bbox = radius_box(*radius)
+	if bbox is not None:
+		north, south, east, west = bbox
+		cell        = store_meta["cell"]
+		columns     = int(round(360 / cell))
+		grid_cells  = np.load(store_dir + "/grid_cells.npy", mmap_mode="r")
+		grid_starts = np.load(store_dir + "/grid_starts.npy", mmap_mode="r")
+		grid_rows   = np.load(store_dir + "/grid_rows.npy", mmap_mode="r")
+		cell_south, cell_west = divmod(int(store_cells(south, west, cell)), columns)
+		cell_north, cell_east = divmod(int(store_cells(north, east, cell)), columns)
+		cell_rows   = np.arange(cell_south, cell_north + 1, dtype=np.int64) * columns
+		column_ranges = [(cell_west, cell_east)] if west <= east else [(cell_west, columns - 1), (0, cell_east)]
+		space_candidates = []
+		for column_first, column_last in column_ranges:
+			cells_first = grid_starts[np.searchsorted(grid_cells, cell_rows + column_first, "left")]
+			cells_last  = grid_starts[np.searchsorted(grid_cells, cell_rows + column_last, "right")]
+			space_candidates.extend((grid_rows, int(first), int(last)) for first, last in zip(cells_first, cells_last) if last > first)
+		if sum(last - first for rows, first, last in space_candidates) < sum(last - first for rows, first, last in candidates):
+			candidates = space_candidates
+	selected = np.concatenate([np.asarray(rows[first:last]) for rows, first, last in candidates] or [np.zeros(0, dtype=np.int64)])
+	selected.sort()
+	selected_records = records[selected]
+	keep = np.ones(len(selected), dtype=bool)
+	if time_from is not None:
+		keep &= selected_records["ts"] >= store_seconds(time_from)
+	if time_to is not None:
+		keep &= (selected_records["ts"] <= store_seconds(time_to)) & (selected_records["ts"] != store_nat)
+	if bbox is not None:
+		keep &= (selected_records["lat"] <= north) & (selected_records["lat"] >= south)
+		if west <= east:
+			keep &= (selected_records["long"] >= west) & (selected_records["long"] <= east)
+		else:
+			keep &= (selected_records["long"] >= west) | (selected_records["long"] <= east)
+	if radius is not None:
+		lat1, long1 = np.radians(radius[0]), np.radians(radius[1])
+		lat2, long2 = np.radians(selected_records["lat"]), np.radians(selected_records["long"])
+		a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1)/2)**2
+		keep &= 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(a, 1))) <= radius[2]
+	return selected[keep], selected_records[keep]
+
+def query():
+	#query subcommand, instead of scan() and normalize(): the waypoints selected in the store (see store_query) are written in a CSV
+	#like the one of a run, so build() and write() create the .KML files with the usual year/month/day folders.
+	#The output files are named <timestamp>_query_*. Returns the number of waypoints selected
+	global numlines, uniq_dates, uniq_models, file_exif, file_GoogleEarth, prefix_thumbs, prefix_heic
+	file_GoogleEarth = ptime + "_query_"
+	file_exif        = file_GoogleEarth + "exif.csv"
+	prefix_thumbs    = file_GoogleEarth + "thumbs"
+	prefix_heic      = file_GoogleEarth + "heic"
+	stage_started = stage_start()
+	time_from = query_time(args.time_from) if args.time_from is not None else None
+	time_to   = query_time(args.time_to, True) if args.time_to is not None else None
+	selected, selected_records = store_query(time_from, time_to, args.bbox, args.radius)
+	with open(store_dir + "/rows.txt", 'rb') as r, open(file_exif, 'w') as w:
+		w.write(exif_header) #header row
+		for offset, length in zip(selected_records["offset"].tolist(), selected_records["length"].tolist()):
+			r.seek(offset)
+			row = r.read(length).decode("utf-8")
+			w.write(row)
+			column = row.split("\t")
+			numlines += 1
+			uniq_dates_counter[column[0][:10]] += 1
+			uniq_models_counter[column[6] + " " + column[7]] += 1
+	uniq_dates  = sorted(uniq_dates_counter)
+	uniq_models = sorted(uniq_models_counter)
+	stage_end("Query", stage_started, numlines)
+	if numlines == 0:
+		os.remove(file_exif)
+	return numlines
+
+def partition_label(timestamp, directory, make, model):
+	#Partition of a row of the CSV sorted by Timestamp (--partition): device, top-level folder of the given path or year
+	if args.partition == "device":
+		return make + " " + model
+	if args.partition == "source":
+		return posixpath.normpath(directory).lstrip("/").split("/")[0]
+	return timestamp[:4]
+
+def partitions_split():
+	#Split the CSV sorted by Timestamp in a CSV for each partition (--partition: device, top-level folder of the given path or year),
+	#keeping the order of the rows. Returns [(name used in the file names, label, waypoints, dates, devices)], biggest partition first
+	part_files = {}
+	part_names = {}
+	part_info  = {}
+	with open(file_exif) as r:
+		header = next(r)
+		for row in r:
+			column = row.split("\t", 8)
+			label  = partition_label(column[0], column[2], column[6], column[7])
+			w = part_files.get(label)
+			if w is None:
+				name = "".join(c if c.isalnum() or c in "-." else "_" for c in label).strip("_.") or "other"
+				while name in part_names.values():
+					name += "_"
+				part_names[label] = name
+				part_info[label]  = [0, set(), set()]
+				w = part_files[label] = open(file_GoogleEarth + name + "_exif.csv", 'w')
+				w.write(header)
+			w.write(row)
+			part_info[label][0] += 1
+			part_info[label][1].add(column[0][:10])
+			part_info[label][2].add(column[6] + " " + column[7])
+	for w in part_files.values():
+		w.close()
+	return sorted(((part_names[label], label, count, sorted(dates), sorted(models)) for label, (count, dates, models) in part_info.items()), key=lambda part: -part[2])
+
+def partition_build(partition_job):
+	#Build a partition (--partition) in a worker process like a whole run on its rows: .heic conversions, thumbnails and .KML files,
+	#saved as <timestamp>_<partition>_*. Returns the statistics of the partition and the distances of its paths
+	global args, ptime, my_os, file_exif, file_GoogleEarth, prefix_thumbs, prefix_heic, numlines, uniq_dates, uniq_models, kmz_files
+	run_args, run_ptime, name, numlines, uniq_dates, uniq_models, cache_options, part_jobs = partition_job
+	cache_init(*cache_options)
+	args             = argparse.Namespace(**dict(vars(run_args), jobs=part_jobs, partition=None, export=None, store=False)) #the export and the store cover all the partitions
+	ptime            = run_ptime + "_" + name
+	my_os            = platform.system()
+	file_GoogleEarth = run_ptime + "_" + name + "_"
+	file_exif        = file_GoogleEarth + "exif.csv"
+	prefix_thumbs    = file_GoogleEarth + "thumbs"
+	prefix_heic      = file_GoogleEarth + "heic"
+	kmz_files        = {}
+	simplify_stats[:] = [0, 0]
+	distance_stats[:] = [0, 0]
+	stage_stats[:]    = []
+	path_distances.clear() #a worker process can build several partitions
+	build()
+	write()
+	os.remove(file_exif) #the rows are also in the CSV of the whole run
+	return list(stage_stats), clustered_count, list(simplify_stats), list(distance_stats), dict(path_distances)
+
+def partitions_creation():
+	#--partition: build the partitions in parallel, "args.jobs" worker processes each building a whole partition, biggest first.
+	#Each partition gets a share of "args.jobs" proportional to its waypoints for its thumbnails and .heic conversions, so a
+	#partition holding most of the waypoints (e.g. a single device) isn't built by a single process.
+	#The stages of the partitions are added up, so they can last longer than the wall-clock time of the partitions. The distances of
+	#the paths of each partition are kept for --export, keyed by (partition, date)
+	global partitions, clustered_count
+	stage_started = stage_start()
+	partitions = partitions_split()
+	partition_jobs = [(args, ptime, name, count, dates, models, (cache_dir, cache_hash), max(1, args.jobs * count // numlines)) for name, label, count, dates, models in partitions]
+	with ProcessPoolExecutor(max_workers=min(args.jobs, len(partition_jobs))) as executor:
+		partition_results = list(executor.map(partition_build, partition_jobs))
+	stage_end("Partitions", stage_started, numlines)
+	partition_stages = {}
+	for (name, label, count, dates, models), (part_stages, part_clustered, part_simplify, part_distance, part_paths) in zip(partitions, partition_results):
+		for stage, wall, cpu, items in part_stages:
+			stage_sum = partition_stages.setdefault(stage.strip(), [0, 0, 0])
+			stage_sum[0] += wall
+			stage_sum[1] += cpu or 0
+			stage_sum[2] += items
+		clustered_count += part_clustered
+		path_distances.update(((label, date), distance) for date, distance in part_paths.items())
+		simplify_stats[0] += part_simplify[0]
+		simplify_stats[1] += part_simplify[1]
+		distance_stats[0] += part_distance[0]
+		distance_stats[1] += part_distance[1]
+	for stage, (wall, cpu, items) in partition_stages.items():
+		stage_stats.append(("  " + stage, wall, cpu, items))
+
+def partitions_index():
+	#Main .KML files of --partition: a NetworkLink to the .KML (or .KMZ) file of each partition
+	kml_ext   = "kmz" if args.kmz else "kml"
+	kml_files = {kml_type: kml_open(kml_type) for kml_type in kml_types}
+	kml_write(kml_files, kml_header("Summary: %d waypoint(s), %d date(s), %d device(s), %d partition(s)" % (numlines,len(uniq_dates),len(uniq_models),len(partitions))))
+	for name, label, count, dates, models in sorted(partitions, key=lambda part: part[1]):
+		for kml_type, w in kml_files.items():
+			w.write(kml_network_link("%s (%d)" % (label, count), "%s%s_%s.%s" % (file_GoogleEarth, name, kml_type, kml_ext)))
+	kml_write(kml_files, "</Document>\n</kml>")
+	for w in kml_files.values():
+		w.close()
+
+def watch_day(date, date_rows, counter_wp_date, line_color):
+	#Write a date again (--watch): its .heic conversions and thumbnails in its own folders, and one .KML file for each kml_type.
+	#The files of a date don't depend on the other dates, so the dates that didn't change are never written again
+	global prefix_thumbs, prefix_heic, clustered_rows, clustered_count, thumbs_failed
+	day_prefix    = watch_prefix(date)
+	prefix_thumbs = day_prefix + "_thumbs"
+	prefix_heic   = day_prefix + "_heic"
+	watch_remove(date)
+	os.makedirs(prefix_thumbs)
+	heic_conversion(date_rows)
+	clustered_rows = set()
+	if args.cluster is not None:
+		for members in day_clusters(date_rows).values():
+			clustered_rows.update(member.row for member in members)
+	clustered_count = len(clustered_rows)
+	thumbs_failed = thumbnails_creation(date_rows)
+	kml_files = {kml_type: kml_open(kml_type, "%s_%s.kml" % (day_prefix, kml_type)) for kml_type in kml_types}
+	kml_write(kml_files, kml_header("%s: %d waypoint(s)" % (date, len(date_rows))))
+	kml_day(kml_files, date, date_rows, counter_wp_date, iter([line_color]), "../")
+	kml_write(kml_files, "</Document>\n</kml>")
+	for w in kml_files.values():
+		w.close()
+
+def watch_prefix(date):
+	#Prefix of the files of a date (--watch), in the folder of the dates
+	return "%sdays/%s" % (file_GoogleEarth, date.replace(":", "-"))
+
+def watch_remove(date):
+	#Remove the files of a date (--watch)
+	day_prefix = watch_prefix(date)
+	for day_dir in (day_prefix + "_thumbs", day_prefix + "_heic"):
+		shutil.rmtree(day_dir, ignore_errors=True)
+	for kml_type in kml_types:
+		if os.path.exists("%s_%s.kml" % (day_prefix, kml_type)):
+			os.remove("%s_%s.kml" % (day_prefix, kml_type))
+
+def watch_index(dates):
+	#Main .KML files of --watch: a NetworkLink to the index of the dates, which links the .KML file of each date (grouped by
+	#year and month). Google Earth loads both again every --watch-interval seconds, so the new dates appear without reopening the file
+	kml_files = {kml_type: kml_open(kml_type, "%sdays/%s.kml" % (file_GoogleEarth, kml_type)) for kml_type in kml_types}
+	kml_write(kml_files, kml_header("Summary: %d waypoint(s), %d date(s), %d device(s)" % (numlines,len(uniq_dates),len(uniq_models))))
+	for yyyy, yyyy_dates in itertools.groupby(dates, key=lambda date: date[:4]):
+		kml_write(kml_files, "\t<Folder>\n\t\t\t<name>%s</name>\n" % yyyy)
+		for yyyy_mm, yyyy_mm_dates in itertools.groupby(yyyy_dates, key=lambda date: date[:7]):
+			kml_write(kml_files, "\t\t\t<Folder>\n\t\t\t\t<name>%s</name>\n" % yyyy_mm)
+			for date in yyyy_mm_dates:
+				for kml_type, w in kml_files.items():
+					w.write(kml_network_link(date, "%s_%s.kml" % (os.path.basename(watch_prefix(date)), kml_type), refresh=args.watch_interval))
+			kml_write(kml_files, "\t\t\t</Folder>\n")
+		kml_write(kml_files, "\t\t</Folder>\n")
+	kml_write(kml_files, "</Document>\n</kml>")
+	for w in kml_files.values():
+		w.close()
+	for kml_type in kml_types:
+		with kml_open(kml_type) as w:
+			w.write(kml_header("geotag2kml --watch"))
+			w.write(kml_network_link("Waypoints", "%sdays/%s.kml" % (os.path.basename(file_GoogleEarth), kml_type), refresh=args.watch_interval))
+			w.write("</Document>\n</kml>")
+
+def watch_update(watch_days, counters_wp_date, line_colors):
+	#An update of --watch: scan the new or changed files, sort the rows again and write only the dates whose waypoints changed.
+	#watch_days: {date: (digest of its waypoints, counter_wp_date, path color)} of the dates written by the previous updates.
+	#Returns the number of dates written or removed
+	run_reset()
+	scan()
+	normalize()
+	stage_started = stage_start()
+	days_updated  = 0
+	dates         = set()
+	for date, date_rows in (exif_days() if numlines > 0 else []):
+		dates.add(date)
+		digest = hashlib.sha1(repr([wp[1:] for wp in date_rows]).encode("utf-8")).hexdigest() #without the row numbers, shifted by the new files of the previous dates
+		if date in watch_days and watch_days[date][0] == digest:
+			continue
+		counter_wp_date, line_color = watch_days[date][1:] if date in watch_days else (next(counters_wp_date), next(line_colors))
+		watch_day(date, date_rows, counter_wp_date, line_color)
+		watch_days[date] = (digest, counter_wp_date, line_color)
+		days_updated += 1
+	for date in sorted(set(watch_days) - dates): #all their files were removed
+		watch_remove(date)
+		del watch_days[date]
+		days_updated += 1
+	watch_index(sorted(watch_days))
+	stage_end("KML files", stage_started, days_updated)
+	return days_updated
+
+def inotify_watcher():
+	#inotify instance watching the folders under the given path (Linux): (file descriptor, {watch descriptor: folder}).
+	#None if inotify isn't available (other systems, too many folders for fs.inotify.max_user_watches)
+	try:
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+		inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+	except (OSError, AttributeError):
+		return None
+	if inotify_fd < 0:
+		return None
+	watcher = (inotify_fd, {})
+	if not inotify_add(watcher, "."):
+		os.close(inotify_fd)
+		return None
+	return watcher
+
+def inotify_add(watcher, folder):
+	#Watch a folder and its subfolders, except the ones that are not scanned (see folder_skipped). False if a watch couldn't be added
+	import ctypes
+	libc = ctypes.CDLL(None, use_errno=True)
+	inotify_fd, watched = watcher
+	for root, dirs, files in os.walk(folder):
+		dirs[:] = [d for d in dirs if not folder_skipped(root, d)]
+		watch_id = libc.inotify_add_watch(inotify_fd, os.fsencode(root), inotify_mask)
+		if watch_id < 0:
+			return False
+		watched[watch_id] = root
+	return True
+
+def inotify_changes(watcher):
+	#Read the pending inotify events. True if a file was added, changed or removed, the output files of the run are ignored
+	inotify_fd, watched = watcher
+	changed = False
+	while True:
+		try:
+			events = os.read(inotify_fd, 65536)
+		except BlockingIOError:
+			return changed
+		offset = 0
+		while offset < len(events):
+			watch_id, mask, cookie, name_length = struct.unpack_from("iIII", events, offset)
+			name   = os.fsdecode(events[offset+16:offset+16+name_length].rstrip(b"\0"))
+			offset += 16 + name_length
+			folder = watched.get(watch_id)
+			if mask & 0x4000: #IN_Q_OVERFLOW: events were lost
+				changed = True
+			elif mask & 0x8000: #IN_IGNORED: the folder was removed
+				watched.pop(watch_id, None)
+			elif folder is None or (folder == "." and (name.startswith(".") or output_name(name))):
+				continue
+			elif mask & 0x40000000: #IN_ISDIR
+				if folder_skipped(folder, name):
+					continue
+				if mask & 0x180: #IN_CREATE, IN_MOVED_TO: watch the new folder
+					inotify_add(watcher, os.path.join(folder, name))
+				changed = True
 			else:
-				heif_winosx = "magick %s/%s %s/%s" % (c_dir,c_fn,prefix_heic,dstfile)
-				os.system(heif_winosx)
-			#remove metadata from the destination .jpg file
-			exift_clean = "exiftool -q -overwrite_original -all= -TagsFromFile %s/%s %s/%s" % (c_dir,c_fn,prefix_heic,dstfile)
-			os.system(exift_clean)
-			#import metadata from the source .heic file
-			exift_add   = "exiftool -q -overwrite_original -TagsFromFile %s/%s -FileModifyDate -FileCreateDate %s/%s" % (c_dir,c_fn,prefix_heic,dstfile)
-			os.system(exift_add)
-
-	#find unique dates. This information will be used to name folders        
-	csv_rows = csv.DictReader(open(file_exif), delimiter='\t')
-
-	uniq_dates  = []
-	uniq_models = []
-
-	for csv_row in csv_rows:
-		csv_TS = csv_row["Timestamp"] #Timestamp, in order of choice: DateTimeOriginal > CreateDate/CreationDate > ModifyDate
-		csv_TS = csv_TS[:10] # Grab YYYY:MM:DD (first 10 characters)
-		csv_MM = csv_row["Make"] + " " + csv_row["Model"] #MM = Make Model
-		uniq_dates.append(csv_TS)
-		uniq_models.append(csv_MM)
-	
-	uniq_dates_counter  = Counter(uniq_dates)
-	uniq_dates          = sorted(set(uniq_dates))  #remove duplicates (set) and sort (sorted)
-	uniq_models_counter = Counter(uniq_models)     #duplicate values are used to count the number of files per device model
-	uniq_models         = sorted(set(uniq_models)) #remove duplicates (set) and sort (sorted)
-	
-	uniq_yyyy = []
-	for uniq_date in uniq_dates:
-		yyyy = uniq_date[:4] #grab YYYY
-		uniq_yyyy.append(yyyy)
-	uniq_yyyy = sorted(set(uniq_yyyy))
-
-	uniq_yyyy_mm = []
-	for uniq_date in uniq_dates:
-		yyyy_mm = uniq_date[:7] #grab YYYY:MM
-		uniq_yyyy_mm.append(yyyy_mm)
-	uniq_yyyy_mm = sorted(set(uniq_yyyy_mm))
-
-	kml_creation("icons")  #create .KML with standard icons
-	kml_creation("thumbs") #create .KML with thumbnails
-
-os.remove(file_temp) #remove temporary CSV file
-
-#script duration time
-end_time = datetime.now()
-print ("\ngeotag2kml (v%s)" % version)
-print ("\nScript started : " + str(start_time))
-print ("Script finished: " + str(end_time))
-print ('Duration       : {}'.format(end_time - start_time))
-print ("-------------------------------------------\n")
-
-#print summary
-print ("Geotagged file(s) found: %d" % numlines)
-
-if numlines > 0:
-	print ("Unique date(s) found   : %d" % len(uniq_dates))
-	counter_path = 0
-	for uniq_date_counter, freq in uniq_dates_counter.most_common():
-		if freq > 1:
-			counter_path +=1
-	print ("Path(s) created        : %d\n" % counter_path)
-	print ("Geotagged file(s) found per device type:")
-	for makemodel, freq in uniq_models_counter.most_common(): #most_common() returns a list ordered from the most common element to the least
-		print ("  *   %s (%d)" % (makemodel,freq))
-	print ("\nOutput files:")
-	print ("  ==> %s" % file_exif)
-	print ("  ==> %s" % file_GoogleEarth + "icons.kml")
-	print ("  ==> %s" % file_GoogleEarth + "thumbs.kml")
+				changed = True
+
+def watch_changes():
+	#Yield every time files were added, changed or removed under the given path (--watch), once they stopped changing (e.g. files
+	#still being copied): with inotify after watch_settle seconds without events, otherwise when two listings of the files taken
+	#--watch-interval seconds apart are the same.
+	#The first yield comes as soon as the watch is set up, before the first update: the files that arrive while it runs are changes
+	watcher = None if args.watch_poll else inotify_watcher()
+	if watcher is None:
+		print ("\nWatching %s (checked every %g s), press Ctrl+C to stop" % (args.path, args.watch_interval))
+		snapshot = list(files_walk(exiftool_extensions()))
+		yield
+		while True:
+			time.sleep(args.watch_interval)
+			files = list(files_walk(exiftool_extensions()))
+			if files != snapshot:
+				while files != snapshot:
+					snapshot = files
+					time.sleep(args.watch_interval)
+					files = list(files_walk(exiftool_extensions()))
+				yield
+	print ("\nWatching %s (inotify), press Ctrl+C to stop" % args.path)
+	try:
+		yield
+		while True:
+			select.select([watcher[0]], [], [])
+			if inotify_changes(watcher):
+				while select.select([watcher[0]], [], [], watch_settle)[0]:
+					inotify_changes(watcher)
+				yield
+	finally:
+		os.close(watcher[0])
+
+def watch_worker_init(cache_dir_run, cache_hash_run):
+	#Initializer of the worker processes of --watch: Ctrl+C stops the main process, which shuts the pool down
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	cache_init(cache_dir_run, cache_hash_run)
+
+def watch():
+	#--watch: update the .KML files after every change under the given path until Ctrl+C. Only the new or changed files are scanned
+	#by ExifTool (see metadata_index) and only the dates whose waypoints changed are written again (see watch_update)
+	global worker_pool
+	watch_days       = {}
+	counters_wp_date = itertools.count(1)
+	line_colors      = path_colors()
+	changes          = watch_changes()
+	if args.jobs > 1:
+		worker_pool = ProcessPoolExecutor(max_workers=args.jobs, initializer=watch_worker_init, initargs=(cache_dir, cache_hash))
+	try:
+		next(changes) #start watching before the first update
+		while True:
+			update_started = time.perf_counter()
+			days_updated   = watch_update(watch_days, counters_wp_date, line_colors)
+			print ("%s  %d file(s) scanned, %d waypoint(s), %d date(s) written in %.1f s" % (datetime.now().strftime('%H:%M:%S'), index_scanned, numlines, days_updated, time.perf_counter() - update_started))
+			next(changes)
+	except KeyboardInterrupt:
+		print ("\nWatch stopped")
+	finally:
+		changes.close()
+		if worker_pool is not None:
+			worker_pool.shutdown()
+			worker_pool = None
+
+def run_end():
+	#End a run: remove the temporary CSV, trim the cache, save --stats-json and go back to the previous working directory
+	global end_time
+	try:
+		if os.path.exists(file_temp):
+			os.remove(file_temp) #remove temporary CSV file
+		cache_evict(args.cache_size * 1048576)
+		end_time = datetime.now()
+		if args.stats_json:
+			stages_json(args.stats_json, (end_time - start_time).total_seconds())
+	finally:
+		os.chdir(run_cwd)
+
+def run_outputs():
+	#Output files of the run, relative to the path analyzed
+	outputs = []
+	if numlines > 0:
+		outputs.append(file_exif)
+		kml_ext = "kml" if args.partition or not args.kmz else "kmz"
+		outputs.append(file_GoogleEarth + "icons." + kml_ext)
+		outputs.append(file_GoogleEarth + "thumbs." + kml_ext)
+		for name, label, count, dates, models in partitions:
+			outputs.append(file_GoogleEarth + name + "_*")
+		for export_format, export_ext in [("parquet", "parquet"), ("arrow", "arrow"), ("geojson", "geojsonl")]:
+			if export_format in (args.export or []):
+				outputs.append(file_GoogleEarth + "waypoints." + export_ext)
+				if export_format != "geojson":
+					outputs.append(file_GoogleEarth + "paths." + export_ext) #in the .geojsonl file, after the waypoints of each date
+		if args.regionate and not args.kmz and not args.partition:
+			outputs.append(file_GoogleEarth + "icons_tiles")
+			outputs.append(file_GoogleEarth + "thumbs_tiles")
+		if args.watch:
+			outputs.append(file_GoogleEarth + "days")
+		if args.profile and not args.partition:
+			outputs.append(file_GoogleEarth + "kml.prof")
+	if args.store and numlines > 0:
+		outputs.append(store_dir)
+	if args.stats_json:
+		outputs.append(args.stats_json)
+	return outputs
+
+def run_summary():
+	#Summary of the last run, returned by run()
+	return {"path": args.path, "started": start_time, "duration_s": (end_time - start_time).total_seconds(),
+		"waypoints": numlines, "dates": uniq_dates, "devices": dict(uniq_models_counter), "clustered": clustered_count,
+		"scanned": index_scanned, "removed_from_index": index_removed,
+		"stages": [{"stage": stage.strip(), "wall_s": wall, "cpu_s": cpu, "items": items} for stage, wall, cpu, items in stage_stats],
+		"outputs": [os.path.join(args.path, output) for output in run_outputs()]}
+
+def run(path, **run_options):
+	#Create the .KML files of a path, like the command line but without printing and without exiting on errors:
+	#  import geotag2kml
+	#  summary = geotag2kml.run("/cases/1", jobs=4, kmz=True)
+	#The options are the ones of the command line (see options). Returns the summary of the run (see run_summary)
+	run_init(options(path, **run_options))
+	try:
+		if args.query:
+			query()
+			build()
+			write()
+		elif args.watch:
+			watch() #until Ctrl+C
+		else:
+			scan()
+			normalize()
+			build()
+			write()
+	finally:
+		run_end()
+	return run_summary()
+
+
+#***************** BEGIN *****************
+if __name__ == "__main__":
+	run_init(welcome())
+	if args.query:
+		query()
+		build()
+		write()
+	elif args.watch:
+		watch() #until Ctrl+C
+	else:
+		scan()
+		normalize()
+		build()
+		write()
+	run_end()
+
+	#script duration time
+	print ("\ngeotag2kml (v%s)" % version)
+	print ("\nScript started : " + str(start_time))
+	print ("Script finished: " + str(end_time))
+	print ('Duration       : {}'.format(end_time - start_time))
+	print ("\n%-26s %10s %10s %10s %10s" % ("Stage", "Wall (s)", "CPU (s)", "Items", "Items/s"))
+	for stage, wall, cpu, items in stage_stats:
+		print ("%-26s %10.2f %10s %10d %10s" % (stage, wall, "%.2f" % cpu if cpu is not None else "-", items, "%.1f" % (items / wall) if wall > 0 else "-"))
+	rss_script, rss_children = peak_rss()
+	if rss_script is not None:
+		print ("Peak RSS (MB)  : %.1f (script), %.1f (biggest child process)" % (rss_script, rss_children))
+	print ("-------------------------------------------\n")
+
+	#print summary
+	print ("Geotagged file(s) found: %d" % numlines)
+	if args.query:
+		pass #the waypoints were read from the store
+	elif args.no_index:
+		print ("File(s) scanned by ExifTool: %d" % index_scanned)
+	else:
+		print ("File(s) scanned by ExifTool: %d (new or changed since the last run), removed from the index: %d" % (index_scanned, index_removed))
+	if args.fast_exif and not args.query:
+		print ("  *   read without ExifTool (--fast-exif): %d file(s), %d of them passed to ExifTool" % (fast_stats[0], fast_stats[1]))
+	for worker_id, (worker_files, worker_time) in enumerate(exift_stats, 1):
+		print ("  *   ExifTool process %d: %d file(s) in %.1f s (%.1f files/s)" % (worker_id, worker_files, worker_time, worker_files / max(worker_time, 0.001)))
+
+	if numlines > 0:
+		print ("Unique date(s) found   : %d" % len(uniq_dates))
+		counter_path = 0
+		for uniq_date_counter, freq in uniq_dates_counter.most_common():
+			if freq > 1:
+				counter_path +=1
+		print ("Path(s) created        : %d" % counter_path)
+		if args.partition:
+			print ("Partitions (%-6s)    : %d" % (args.partition, len(partitions)))
+		if args.cluster is not None:
+			print ("Clustered waypoints    : %d (placemarks: %d)" % (clustered_count, numlines - clustered_count))
+		if args.simplify is not None:
+			print ("Path vertices removed  : %d of %d (--simplify %g m)" % (simplify_stats[0] - simplify_stats[1], simplify_stats[0], args.simplify))
+		print ("")
+		print ("Geotagged file(s) found per device type:")
+		for makemodel, freq in uniq_models_counter.most_common(): #most_common() returns a list ordered from the most common element to the least
+			print ("  *   %s (%d)" % (makemodel,freq))
+	outputs = run_outputs()
+	if outputs:
+		print ("\nOutput files:")
+	for output in outputs:
+		print ("  ==> %s" % output)